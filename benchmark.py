@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks for feature_engineering.py.
+  generate: writes synthetic Instacart-shaped competition files for a given number of users
+  pipeline: times and memory-profiles the pipeline stages on synthetic data of several sizes
+  walk:     checks the numba order walk of user_computations against the numpy one, and times both per user
+  service:  times feature lookups, run from a folder where feature_engineering.py has built Feature_state
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import pandas as pd
+import feature_engineering as fe
+
+# sizes of the competition product catalogue
+N_PRODUCTS, N_AISLES, N_DEPARTMENTS = 49688, 134, 21
+
+# share of orders by day of week and by hour of day, roughly as in the competition orders.csv
+DOW_WEIGHTS = [.19, .17, .14, .13, .12, .13, .12]
+HOUR_WEIGHTS = [.007, .004, .002, .002, .002, .003, .009, .028, .053, .076, .085, .085,
+			.081, .080, .081, .080, .077, .066, .052, .039, .030, .024, .019, .012]
+
+# stages timed by bench_pipeline(), in the order they run
+PIPELINE_STAGES = ['generate_new_df', 'make_chunks', 'user_computations', 'do_computations', 'merge_chunks', 'last_merges']
+
+
+def zipf_weights(n, exponent=1.):
+	'''
+	Returns n probabilities falling off as 1/rank**exponent.
+	'''
+	weights = 1. / numpy.arange(1, n+1)**exponent
+	return weights / weights.sum()
+
+def generate_data(n_users, folder='.', seed=0, n_products=N_PRODUCTS):
+	'''
+	Writes orders.csv, order_products__prior.csv, order_products__train.csv and products.csv for n_users
+	synthetic users to folder, in the layout of the competition files:
+	- 4 to 100 orders per user (geometric, about 17 on average), the last one in the train (64%) or test set
+	- days_since_prior_order drawn around a per-user cadence and capped at 30, NaN for first orders
+	- geometric basket sizes of about 10 items, test orders have no products
+	- products from 134 aisles in 21 departments, both with Zipf-skewed sizes, and Zipf product popularity
+	- every user shops from a personal pool of products, favouring the first ones, so most items are reorders
+	'''
+	rng = numpy.random.RandomState(seed)
+	if not os.path.exists(folder):
+		os.makedirs(folder)
+
+	#products, aisle and department ids are shuffled so their size is unrelated to their id
+	aisle_department = rng.permutation(N_DEPARTMENTS)[rng.choice(N_DEPARTMENTS, N_AISLES, p=zipf_weights(N_DEPARTMENTS))] + 1
+	product_aisle = rng.permutation(N_AISLES)[rng.choice(N_AISLES, n_products, p=zipf_weights(N_AISLES))]
+	products = pd.DataFrame({'product_id':numpy.arange(1, n_products+1)})
+	products['product_name'] = numpy.where(rng.rand(n_products)<.1, 'Organic Product ', 'Product ') + products['product_id'].astype(str)
+	products['aisle_id'] = product_aisle + 1
+	products['department_id'] = aisle_department[product_aisle]
+	popularity = zipf_weights(n_products)[rng.permutation(n_products)]
+
+	#orders, sorted by user_id and order_number like the competition file, with shuffled order_ids
+	n_orders = numpy.minimum(rng.geometric(1/14., n_users) + 3, 100)
+	first = numpy.cumsum(n_orders) - n_orders
+	user = numpy.repeat(numpy.arange(n_users), n_orders)
+	order_number = numpy.arange(len(user)) - first[user] + 1
+	last = order_number==n_orders[user]
+	eval_set = numpy.where(last, numpy.where(rng.rand(n_users)<.64, 'train', 'test')[user], 'prior')
+	cadence = rng.gamma(2., 6., n_users)
+	days = numpy.minimum(numpy.round(rng.exponential(cadence[user])), 30.)
+	days[order_number==1] = numpy.nan
+	orders = pd.DataFrame({'order_id':rng.permutation(len(user)) + 1, 'user_id':user + 1, 'eval_set':eval_set,
+					'order_number':order_number, 'order_dow':rng.choice(7, len(user), p=DOW_WEIGHTS),
+					'order_hour_of_day':rng.choice(24, len(user), p=numpy.array(HOUR_WEIGHTS)/sum(HOUR_WEIGHTS)),
+					'days_since_prior_order':days})
+
+	#baskets, drawn from each user's pool (repeated draws within a basket are dropped)
+	basket = numpy.minimum(rng.geometric(1/12., len(user)), 145) * (eval_set!='test')
+	pool_size = 10 + 4*n_orders
+	pool_start = numpy.cumsum(pool_size) - pool_size
+	pool = rng.choice(n_products, pool_size.sum(), p=popularity) + 1
+	item_order = numpy.repeat(numpy.arange(len(user)), basket)
+	item_user = user[item_order]
+	pick = (pool_size[item_user] * rng.rand(len(item_order))**1.5).astype('int64')
+	items = pd.DataFrame({'order_row':item_order, 'user_id':item_user, 'product_id':pool[pool_start[item_user] + pick]})
+	items = items.drop_duplicates(['order_row', 'product_id'])
+
+	#rows are in order_number order within each user, so a product is a reorder after its first row
+	items['add_to_cart_order'] = items.groupby('order_row').cumcount() + 1
+	items['reordered'] = items.duplicated(['user_id', 'product_id']).astype('int8')
+	items['order_id'] = orders['order_id'].values[items['order_row'].values]
+	in_train = eval_set[items['order_row'].values]=='train'
+
+	columns = ['order_id', 'product_id', 'add_to_cart_order', 'reordered']
+	products.to_csv(os.path.join(folder, 'products.csv'), index=False)
+	orders.to_csv(os.path.join(folder, 'orders.csv'), index=False)
+	items[~in_train].sort_values(['order_id', 'add_to_cart_order'])[columns].to_csv(os.path.join(folder, 'order_products__prior.csv'), index=False)
+	items[in_train].sort_values(['order_id', 'add_to_cart_order'])[columns].to_csv(os.path.join(folder, 'order_products__train.csv'), index=False)
+	return len(orders), len(items)
+
+def user_computations_stage(chunk=0):
+	'''
+	Applies user_computations to every user of one chunk's partition, as do_computations(engine='python') would.
+	'''
+	with fe.instrument('user_computations', chunk=chunk) as record:
+		new = fe.load_frame(fe.partition_name(chunk))
+		record['users'] = int(new['user_id'].nunique())
+		new.groupby('user_id').apply(fe.user_computations)
+
+def run_stage(stage, *args):
+	'''
+	Runs a pipeline stage in a fresh process, so the peak RSS in its metrics record belongs to that stage alone
+	(plus the cost of importing pandas), and returns the record.
+	'''
+	func = user_computations_stage if stage=='user_computations' else getattr(fe, stage)
+	with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+		pool.submit(func, *args).result()
+	with open(fe.METRICS_FILE) as fp:
+		return [json.loads(line) for line in fp if json.loads(line)['stage']==stage][-1]
+
+def bench_pipeline(user_counts=(1000, 10000, 100000), workers=1, seed=0, output=None, keep=False):
+	'''
+	For each number of users, generates synthetic data in a temporary folder and runs the pipeline on it,
+	one stage per process. Prints the wall time, CPU time, peak RSS and rows read/written of every stage;
+	user_computations is the per-user loop on one chunk (1/50 of the users), do_computations the
+	vectorized engine on all chunks.
+	Records are appended to output (a JSON lines file) when given, to compare runs against each other.
+	A stage that fails is reported and ends the run for that size.
+	'''
+	start_folder = os.getcwd()
+	output = None if output is None else os.path.abspath(output)
+	results = []
+	for n_users in user_counts:
+		folder = tempfile.mkdtemp(prefix='instacart_bench_{}_'.format(n_users))
+		start = time.perf_counter()
+		#generated in another process too, as the processes of the stages inherit this one's peak RSS
+		with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+			n_orders, n_items = pool.submit(generate_data, n_users, folder, seed).result()
+		print("{} users: {} orders, {} order_products rows generated in {:.1f}s".format(n_users, n_orders, n_items, time.perf_counter()-start))
+
+		os.chdir(folder)
+		try:
+			for stage in PIPELINE_STAGES:
+				args = {'user_computations':(0,), 'do_computations':('vectorized', workers)}.get(stage, ())
+				try:
+					record = run_stage(stage, *args)
+				except Exception as error:
+					record = {'stage':stage, 'error':repr(error)}
+				record['n_users'] = n_users
+				results.append(record)
+				if output is not None:
+					with open(output, 'a') as fp:
+						fp.write(json.dumps(record) + '\n')
+				if 'error' in record:
+					print("  {:<20}failed: {}".format(stage, record['error']))
+					break
+				print("  {:<20}{:>9.2f}s wall {:>9.2f}s cpu {:>9.1f}MB peak {:>11} rows in {:>11} rows out".format(
+					stage, record['wall_seconds'], record['cpu_seconds'], record['peak_rss_mb'] or 0, record['rows_in'], record['rows_out']))
+		finally:
+			os.chdir(start_folder)
+			if keep:
+				print("  files kept in", folder)
+			else:
+				shutil.rmtree(folder)
+	return results
+
+def bench_order_walk(n_users=2000, seed=0, buckets=(4, 11, 31, 101)):
+	'''
+	Generates synthetic data for n_users, then runs user_computations on every user with ORDER_WALK='numpy'
+	and ORDER_WALK='numba', raising an AssertionError if any value differs between them.
+	Prints the mean time per user, for the whole of user_computations and for the order walk alone,
+	by history length (number of orders, split at buckets).
+	'''
+	if fe.numba_walk() is None:
+		raise ImportError('numba is not installed')
+	start_folder = os.getcwd()
+	folder = tempfile.mkdtemp(prefix='instacart_walk_')
+	try:
+		generate_data(n_users, folder, seed)
+		os.chdir(folder)
+		fe.generate_new_df()
+		new = fe.load_frame('instacart_merged_new').sort_values(['user_id', 'target', 'order_number'], ascending=[True, False, False], kind='mergesort')
+	finally:
+		os.chdir(start_folder)
+		shutil.rmtree(folder)
+
+	users = [group for _, group in new.groupby('user_id')]
+	kernel = fe.numba_walk()
+	fe.user_computations(users[0])
+	times = {}
+	for group in users:
+		features, seconds = {}, {}
+		for backend in ['numpy', 'numba']:
+			fe.ORDER_WALK = backend
+			start = time.perf_counter()
+			features[backend] = fe.user_computations(group)
+			seconds[backend] = time.perf_counter()-start
+
+			history = fe.encode_history(group, bitmaps=backend=='numpy')
+			start = time.perf_counter()
+			for level in ['products', 'aisles', 'departments']:
+				fe.walk_level(level, history, kernel if backend=='numba' else None, level=='products')
+			seconds[backend+' walk'] = time.perf_counter()-start
+		pd.testing.assert_frame_equal(features['numpy'], features['numba'])
+
+		orders = int(group['order_number_max'].iloc[0])
+		bucket = max(low for low in buckets[:-1] if orders>=low)
+		times.setdefault(bucket, []).append(seconds)
+	fe.ORDER_WALK = 'numba'
+
+	print("{} users, numba and numpy walks match\n".format(len(users)))
+	print("{:<12}{:>8}{:>14}{:>14}{:>10}{:>14}{:>14}{:>10}".format('orders', 'users', 'numpy (ms)', 'numba (ms)', 'speedup',
+																	'numpy walk', 'numba walk', 'speedup'))
+	for low, high in zip(buckets[:-1], buckets[1:]):
+		if low not in times:
+			continue
+		mean = {key:1000*numpy.mean([seconds[key] for seconds in times[low]]) for key in times[low][0]}
+		print("{:<12}{:>8}{:>14.2f}{:>14.2f}{:>9.1f}x{:>14.3f}{:>14.3f}{:>9.1f}x".format('{}-{}'.format(low, high-1), len(times[low]),
+			mean['numpy'], mean['numba'], mean['numpy']/mean['numba'], mean['numpy walk'], mean['numba walk'], mean['numpy walk']/mean['numba walk']))
+	return times
+
+def percentiles(times):
+	'''
+	Returns the p50 and p99 of a list of durations in seconds, in milliseconds.
+	'''
+	return numpy.percentile(numpy.array(times)*1000, [50, 99])
+
+def bench_feature_service(lookups=1000, batch_size=1000, batches=20, seed=0):
+	'''
+	Times features_for_user() for single users (cold: read from Feature_state, warm: from the LRU cache)
+	and features_for_users() for batches of batch_size users, printing p50/p99 latencies.
+	'''
+	user_ids = fe.load_frame(fe.state_name('users'), columns=['user_id'])['user_id'].values
+	rng = numpy.random.RandomState(seed)
+	sample = rng.choice(user_ids, size=min(lookups, len(user_ids)), replace=False)
+
+	fe.clear_feature_cache()
+	fe.cached_overall_averages()
+
+	results = []
+	for label in ['single user, cold', 'single user, warm']:
+		times = []
+		for user_id in sample:
+			start = time.perf_counter()
+			fe.features_for_user(user_id)
+			times.append(time.perf_counter()-start)
+		results.append((label, len(times))+tuple(percentiles(times)))
+
+	times = []
+	for _ in range(batches):
+		fe.clear_feature_cache()
+		fe.cached_overall_averages()
+		batch = rng.choice(user_ids, size=min(batch_size, len(user_ids)), replace=False)
+		start = time.perf_counter()
+		fe.features_for_users(batch)
+		times.append(time.perf_counter()-start)
+	results.append(('batch of {} users, cold'.format(len(batch)), len(times))+tuple(percentiles(times)))
+
+	print("{:<30}{:>8}{:>12}{:>12}".format('lookup', 'runs', 'p50 (ms)', 'p99 (ms)'))
+	for label, runs, p50, p99 in results:
+		print("{:<30}{:>8}{:>12.1f}{:>12.1f}".format(label, runs, p50, p99))
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	commands = parser.add_subparsers(dest='command')
+
+	generate = commands.add_parser('generate', help='write synthetic competition files')
+	generate.add_argument('users', type=int, help='number of users')
+	generate.add_argument('folder', nargs='?', default='.', help='folder to write the files to')
+	generate.add_argument('--seed', type=int, default=0)
+
+	pipeline = commands.add_parser('pipeline', help='time the pipeline stages on synthetic data')
+	pipeline.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000], help='numbers of users to run')
+	pipeline.add_argument('--workers', type=int, default=1, help='worker processes for do_computations')
+	pipeline.add_argument('--seed', type=int, default=0)
+	pipeline.add_argument('--output', help='JSON lines file to append the stage records to')
+	pipeline.add_argument('--keep', action='store_true', help='keep the generated folders')
+
+	walk = commands.add_parser('walk', help='compare the numba and numpy order walks of user_computations')
+	walk.add_argument('--users', type=int, default=2000, help='number of synthetic users')
+	walk.add_argument('--seed', type=int, default=0)
+
+	service = commands.add_parser('service', help='time feature lookups from Feature_state')
+	service.add_argument('--lookups', type=int, default=1000, help='number of single-user lookups')
+	service.add_argument('--batch-size', type=int, default=1000, help='users per batch lookup')
+	service.add_argument('--batches', type=int, default=20, help='number of batch lookups')
+	args = parser.parse_args()
+
+	if args.command=='generate':
+		generate_data(args.users, args.folder, args.seed)
+	elif args.command=='pipeline':
+		bench_pipeline(args.users, args.workers, args.seed, args.output, args.keep)
+	elif args.command=='walk':
+		bench_order_walk(args.users, args.seed)
+	elif args.command=='service':
+		bench_feature_service(args.lookups, args.batch_size, args.batches)
+	else:
+		parser.print_help()
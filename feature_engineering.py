@@ -1,251 +1,1301 @@
 #!/usr/bin/env python
 
-# Import relevant packages, filter warnings
+# Import relevant packages, optional ones (pyarrow, numba) are only imported when first used
 import pandas as pd
 import numpy
 import os
+import sys
+import json
+import time
 import pickle
+import argparse
+import subprocess
+import sqlite3
+import functools
+import hashlib
+import inspect
+import heapq
+import cProfile
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from importlib.util import find_spec
 import warnings
-warnings.filterwarnings('ignore')
 
+try:
+	import resource
+except ImportError:
+	resource = None
+
+# format used for the intermediate and final files: 'parquet', 'feather' or 'csv'
+# parquet and feather need pyarrow, csv is used when it is not installed
+STORAGE_FORMAT = 'parquet' if find_spec('pyarrow') is not None else 'csv'
+EXTENSIONS = {'parquet':'.parquet', 'feather':'.feather', 'csv':'.csv'}
+
+def arrow():
+	'''
+	Returns pyarrow, with its parquet and ipc modules, importing it on first use.
+	'''
+	import pyarrow
+	import pyarrow.ipc
+	import pyarrow.parquet
+	return pyarrow
+
+# every instrumented stage appends a JSON line with its measurements to this file, None turns the records off
+METRICS_FILE = 'pipeline_metrics.jsonl'
+IO_FIELDS = ['rows_in', 'rows_out', 'bytes_read', 'bytes_written']
+open_stages = []
+
+def cpu_seconds():
+	'''
+	User plus system CPU time of this process and of its finished child processes (e.g. the chunk workers).
+	'''
+	times = os.times()
+	return times.user + times.system + times.children_user + times.children_system
+
+def peak_rss_mb():
+	'''
+	High-water mark of the resident set size, in MB, of this process and of its largest finished child,
+	or None where the resource module is not available (Windows).
+	'''
+	if resource is None:
+		return None
+	peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+	return round(peak / (2**20 if sys.platform=='darwin' else 2**10), 1)
+
+def count_io(**counts):
+	'''
+	Adds rows_in, rows_out, bytes_read and/or bytes_written to the innermost open stage, if any.
+	'''
+	if open_stages:
+		for field, value in counts.items():
+			open_stages[-1][field] += int(value)
+
+def current_stage():
+	'''
+	The record of the innermost open stage, where a stage can add its own fields, or a throwaway dict outside any stage.
+	'''
+	return open_stages[-1] if open_stages else {}
+
+def write_metrics(record):
+	if METRICS_FILE is not None:
+		with open(METRICS_FILE, 'a') as fp:
+			fp.write(json.dumps(record) + '\n')
+
+@contextmanager
+def instrument(stage, **fields):
+	'''
+	Measures the code in the with block as one stage: wall time, CPU time, peak RSS, and the rows and bytes
+	read and written through load_frame(), save_frame(), save_frames() and the csv readers.
+	The record is yielded so the block can add its own fields, and is appended to METRICS_FILE on exit.
+	The I/O of a nested stage also counts toward the stage it runs in.
+	peak_rss_mb is the process high-water mark when the stage ends, so it only grows from stage to stage.
+	'''
+	record = dict(stage=stage, started=datetime.now().isoformat(), **fields)
+	record.update({field:0 for field in IO_FIELDS})
+	wall, cpu = time.perf_counter(), cpu_seconds()
+	open_stages.append(record)
+	try:
+		yield record
+	except BaseException as error:
+		record['error'] = repr(error)
+		raise
+	finally:
+		open_stages.pop()
+		record['wall_seconds'] = round(time.perf_counter() - wall, 3)
+		record['cpu_seconds'] = round(cpu_seconds() - cpu, 3)
+		record['peak_rss_mb'] = peak_rss_mb()
+		count_io(**{field:record[field] for field in IO_FIELDS})
+		write_metrics(record)
+
+def instrumented(func):
+	'''
+	Decorator running every call of func as a stage named after it (see instrument()).
+	'''
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		with instrument(func.__name__):
+			return func(*args, **kwargs)
+	return wrapper
+
+@contextmanager
+def profiled(profile, name, record):
+	'''
+	Opt-in profiling of the code in the with block.
+	profile='cprofile' dumps cProfile stats to Profiles/{name}.prof (read them with pstats or snakeviz),
+	profile='tracemalloc' adds the traced peak and the ten largest allocation sites to record,
+	and profile=None runs the block unprofiled.
+	'''
+	if profile is None:
+		yield
+	elif profile=='cprofile':
+		if not os.path.exists('Profiles'):
+			os.makedirs('Profiles')
+		profiler = cProfile.Profile()
+		profiler.enable()
+		try:
+			yield
+		finally:
+			profiler.disable()
+			record['profile'] = os.path.join('Profiles', name + '.prof')
+			profiler.dump_stats(record['profile'])
+	elif profile=='tracemalloc':
+		tracemalloc.start()
+		try:
+			yield
+		finally:
+			record['tracemalloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+			record['tracemalloc_top'] = [str(stat) for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]]
+			tracemalloc.stop()
+	else:
+		raise ValueError("Unknown profile {!r}, expected 'cprofile', 'tracemalloc' or None".format(profile))
+
+# compact dtypes declared for every column the pipeline writes, float64 columns not listed here are stored as float32
+SCHEMA = {
+	'order_id':'int32', 'product_id':'int32', 'user_id':'int32', 'aisle_id':'int32', 'department_id':'int32',
+	'order_number':'int16', 'order_number_max':'int16', 'num_orders_placed':'int16',
+	'order_dow':'uint8', 'order_hour_of_day':'uint8', 'target':'uint8', 'streak_length':'int16',
+	'eval_set':pd.CategoricalDtype(['prior', 'train', 'test']),
+	'add_to_cart_order':'float32', 'reordered':'float32', 'ord_size':'float32', 'days_since_prior_order':'float32',
+	'orders_since_prod':'float32', 'last_order_id':'int32', 'target_order_id':'int32', 'last_order':'int16',
+	'last_prior':'int16', 'n_prior':'int16', 'run':'int16', 'in_target':'uint8',
+	'last_hour':'uint8', 'last_dow':'uint8', 'target_hour':'uint8', 'target_dow':'uint8',
+	'num_orders':'int16', 'num_products':'int32', 'cost':'int64',
+	}
+
+def apply_schema(df):
+	'''
+	Casts the columns of df to the compact dtypes in SCHEMA.
+	'''
+	dtypes = {col:SCHEMA[col] if col in SCHEMA else 'float32' for col in df.columns
+			if col in SCHEMA or df[col].dtype=='float64'}
+	return df.astype(dtypes)
+
+def set_storage_format(fmt):
+	'''
+	Sets STORAGE_FORMAT, also in the worker processes of do_computations(), which start with the module's default.
+	'''
+	global STORAGE_FORMAT
+	STORAGE_FORMAT = fmt
+
+def artifact_path(name, fmt=None):
+	return name + EXTENSIONS[fmt or STORAGE_FORMAT]
+
+def artifact_exists(name, fmt=None):
+	return os.path.isfile(artifact_path(name, fmt))
+
+def save_frame(df, name, fmt=None, row_group_size=None):
+	'''
+	Saves df as artifact name (a path without extension) in the given format, defaulting to STORAGE_FORMAT.
+	The file is written under a temporary name and then renamed into place, so an interrupted
+	run never leaves a partial file that a later run would treat as complete.
+	row_group_size sets the parquet row groups, smaller groups make filtered reads (see load_frame()) cheaper.
+	'''
+	fmt = fmt or STORAGE_FORMAT
+	filename = artifact_path(name, fmt)
+	temp = filename + '.tmp'
+
+	df = apply_schema(df)
+	if fmt=='parquet':
+		df.to_parquet(temp, index=False, row_group_size=row_group_size)
+	elif fmt=='feather':
+		df.reset_index(drop=True).to_feather(temp)
+	else:
+		df.to_csv(temp)
+	os.replace(temp, filename)
+	count_io(rows_out=len(df), bytes_written=os.path.getsize(filename))
+
+def save_frames(frames, name, fmt=None):
+	'''
+	Saves an iterable of dataframes, all with the same columns, as a single artifact name,
+	writing each piece as it arrives so the full frame is never held in memory.
+	Like save_frame(), the file only appears under its final name once every piece is written.
+	'''
+	fmt = fmt or STORAGE_FORMAT
+	filename = artifact_path(name, fmt)
+	temp = filename + '.tmp'
+
+	writer, rows = None, 0
+	for df in frames:
+		df = apply_schema(df)
+		if fmt=='csv':
+			df.index = pd.RangeIndex(rows, rows+len(df))
+			df.to_csv(temp, mode='a' if rows else 'w', header=not rows)
+		else:
+			if writer is None:
+				pyarrow = arrow()
+				schema = pyarrow.Schema.from_pandas(df, preserve_index=False)
+				if fmt=='parquet':
+					writer = pyarrow.parquet.ParquetWriter(temp, schema)
+				else:
+					writer = pyarrow.ipc.new_file(temp, schema)
+			writer.write_table(pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False))
+		rows += len(df)
+
+	if writer is not None:
+		writer.close()
+	elif not rows:
+		raise ValueError('No data to save as {}'.format(filename))
+	os.replace(temp, filename)
+	count_io(rows_out=rows, bytes_written=os.path.getsize(filename))
+
+def load_frame(name, fmt=None, columns=None, user_ids=None):
+	'''
+	Reads artifact name (saved by save_frame()) back with the compact dtypes in SCHEMA,
+	optionally only the rows of the given user_ids. Parquet files skip the row groups
+	holding none of those users.
+	'''
+	fmt = fmt or STORAGE_FORMAT
+	filename = artifact_path(name, fmt)
+
+	if fmt=='parquet':
+		filters = None if user_ids is None else [('user_id', 'in', [int(user_id) for user_id in user_ids])]
+		df = pd.read_parquet(filename, columns=columns, filters=filters)
+	elif fmt=='feather':
+		df = pd.read_feather(filename, columns=columns)
+	else:
+		# the unnamed first column is the index written by save_frame()
+		usecols = None if columns is None else (lambda col:col in columns or col.startswith('Unnamed: 0'))
+		df = pd.read_csv(filename, index_col=0, usecols=usecols)
+	if user_ids is not None:
+		df = df[df['user_id'].isin(user_ids)].reset_index(drop=True)
+	count_io(rows_in=len(df), bytes_read=os.path.getsize(filename))
+	return apply_schema(df)
+
+def artifact_columns(name, fmt=None):
+	'''
+	Returns the column names of artifact name, reading only its schema or header.
+	'''
+	fmt = fmt or STORAGE_FORMAT
+	filename = artifact_path(name, fmt)
+	if fmt=='parquet':
+		return arrow().parquet.read_schema(filename).names
+	elif fmt=='feather':
+		with arrow().ipc.open_file(filename) as reader:
+			return reader.schema.names
+	return list(pd.read_csv(filename, index_col=0, nrows=0).columns)
+
+def remove_artifact(name):
+	'''
+	Removes artifact name in every format it was saved in.
+	'''
+	for ext in EXTENSIONS.values():
+		if os.path.isfile(name + ext):
+			os.remove(name + ext)
+
+# the cache manifest records, for every cached output, the key of the inputs, parameters and code it was made from
+CACHE_MANIFEST = 'cache_manifest.json'
+# disk cap in bytes for the cached intermediate files (see evict_cache()), None for no cap
+CACHE_LIMIT = None
+# the competition-provided files the pipeline starts from
+INPUT_FILES = ['orders.csv', 'products.csv', 'order_products__prior.csv', 'order_products__train.csv']
+# the functions whose source goes into each stage's key, so editing them reruns the stage
+STAGE_CODE = {
+	'generate_new_df':['generate_new_df', 'pandas_generate_new_df', 'merge_rows', 'index_array', 'read_chunks', 'read_input',
+					'sql_generate_new_df', 'sql_merged_layout', 'new_product_index', 'product_codes', 'product_lookup', 'count_products'],
+	'make_chunks':['make_chunks', 'balanced_chunks', 'user_costs', 'save_partitions', 'sql_partitions'],
+	'make_shards':['make_shards', 'shard_of', 'save_partitions', 'sql_partitions'],
+	'compute_chunk':['compute_chunk', 'vectorized_computations', '_segment_features', 'user_computations',
+					'encode_history', 'walk_presence', 'walk_orders', 'walk_level'],
+	'merge_chunks':['merge_chunks'],
+	'last_merges':['last_merges', 'final_rows', 'sql_final_rows', 'finalize_features', 'is_organic', 'product_features', 'target_orders'],
+	'build_feature_state':['build_feature_state', 'merged_state', 'target_orders', 'fold_keys', 'fold_orders', 'set_targets',
+						'save_feature_state', 'overall_averages'],
+	}
+
+def load_manifest():
+	if not os.path.isfile(CACHE_MANIFEST):
+		return {'entries':{}, 'digests':{}}
+	with open(CACHE_MANIFEST) as fp:
+		return json.load(fp)
+
+def save_manifest(manifest):
+	with open(CACHE_MANIFEST + '.tmp', 'w') as fp:
+		json.dump(manifest, fp, indent=1, sort_keys=True)
+	os.replace(CACHE_MANIFEST + '.tmp', CACHE_MANIFEST)
+
+def file_digest(path):
+	'''
+	Returns a hash of the contents of file path. Hashes are kept in the manifest with the file's size and
+	modification time, and a file is only read again once either changes.
+	'''
+	manifest = load_manifest()
+	stat = os.stat(path)
+	known = manifest['digests'].get(path)
+	if known is not None and known['size']==stat.st_size and known['mtime_ns']==stat.st_mtime_ns:
+		return known['digest']
+
+	digest = hashlib.blake2b(digest_size=16)
+	with open(path, 'rb') as fp:
+		for block in iter(lambda:fp.read(2**20), b''):
+			digest.update(block)
+	manifest['digests'][path] = {'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'digest':digest.hexdigest()}
+	save_manifest(manifest)
+	return digest.hexdigest()
+
+def stage_key(stage, *inputs):
+	'''
+	Returns the cache key of a run of stage: a hash of its inputs (digests, upstream keys and parameters),
+	the source of its functions (STAGE_CODE), the storage format and SCHEMA.
+	'''
+	code = [inspect.getsource(globals()[name]) for name in STAGE_CODE[stage]]
+	parts = [stage, list(inputs), code, STORAGE_FORMAT, repr(SCHEMA)]
+	return hashlib.blake2b(json.dumps(parts, default=str).encode(), digest_size=16).hexdigest()
+
+def cache_key(name):
+	'''
+	Returns the key that cached output name was made with, or None if it is not cached.
+	'''
+	entry = load_manifest()['entries'].get(name)
+	return None if entry is None else entry['key']
+
+def cache_hit(name, key):
+	'''
+	True when output name was made with key and all its files are still there, in which case it is marked as used.
+	'''
+	manifest = load_manifest()
+	entry = manifest['entries'].get(name)
+	if entry is None or entry['key']!=key or not all(os.path.isfile(path) for path in entry['files']):
+		return False
+	entry['used'] = time.time()
+	save_manifest(manifest)
+	return True
+
+def cache_store(name, key, files, evictable=True):
+	'''
+	Records that output name, made of files, was made with key.
+	Evictable outputs are intermediate files that evict_cache() may remove.
+	'''
+	manifest = load_manifest()
+	manifest['entries'][name] = {'key':key, 'files':files, 'bytes':sum(os.path.getsize(path) for path in files),
+								'used':time.time(), 'evictable':evictable}
+	save_manifest(manifest)
+
+def evict_cache(limit=None):
+	'''
+	Removes the least recently used intermediate outputs (and their manifest entries) until the cached
+	intermediate files take at most limit bytes, CACHE_LIMIT by default. The final outputs are never removed.
+	An evicted output is simply made again by its stage on the next run.
+	'''
+	limit = CACHE_LIMIT if limit is None else limit
+	if limit is None:
+		return
+	manifest = load_manifest()
+	entries = sorted([(entry['used'], name) for name, entry in manifest['entries'].items() if entry['evictable']])
+	total = sum(manifest['entries'][name]['bytes'] for _, name in entries)
+	for _, name in entries:
+		if total<=limit:
+			break
+		entry = manifest['entries'].pop(name)
+		for path in entry['files']:
+			if os.path.isfile(path):
+				os.remove(path)
+		total -= entry['bytes']
+		print("- evicted", name, "({:.1f} MB)".format(entry['bytes']/2.**20))
+	save_manifest(manifest)
+
+
+# backend of the order walk in user_computations(): 'numba' runs walk_orders() compiled, when numba is installed,
+# 'numpy' (and the fallback without numba) walks presence bitmaps with numpy
+ORDER_WALK = 'numba'
+compiled_walk = None
+
+def encode_history(big_group, bitmaps=True):
+	'''
+	Encodes the rows of one user (in the layout of instacart_merged_new) as integer arrays.
+	The user's products, aisles and departments are numbered from 0, and orders are numbered in the order
+	they first appear (newest first in the partitions). The rows of order k are rows order_start[k]:order_start[k+1]
+	of row_product, row_aisle and row_department, and present_products[k, p] (present_aisles, present_departments)
+	is True when order k contains the user's product (aisle, department) p; bitmaps=False leaves them out.
+	'''
+	product_ids, row_product = numpy.unique(big_group['product_id'].values, return_inverse=True)
+	aisle_ids, row_aisle = numpy.unique(big_group['aisle_id'].values, return_inverse=True)
+	department_ids, row_department = numpy.unique(big_group['department_id'].values, return_inverse=True)
+	row_order, order_number = pd.factorize(big_group['order_number'].values)
+	n_orders, n_products = len(order_number), len(product_ids)
+
+	#rows grouped by order
+	rows = numpy.argsort(row_order, kind='mergesort')
+	order_start = numpy.zeros(n_orders+1, dtype='int64')
+	order_start[1:] = numpy.cumsum(numpy.bincount(row_order, minlength=n_orders))
+	first_row = rows[order_start[:-1]]
+
+	history = {
+		'product_ids':product_ids,
+		'order_number':order_number.astype('int64'),
+		'order_days':big_group['days_since_prior_order'].values[first_row].astype('float64'),
+		'in_target':numpy.asarray(big_group['eval_set'].values[first_row]!='prior'),
+		'order_num_max':int(big_group['order_number_max'].max()),
+		'order_start':order_start,
+		'row_product':row_product[rows],
+		'row_aisle':row_aisle[rows],
+		'row_department':row_department[rows],
+		'product_aisle':numpy.zeros(n_products, dtype='int64'),
+		'product_department':numpy.zeros(n_products, dtype='int64'),
+		'product_order_number':numpy.zeros(n_products, dtype='int64'),
+		'product_target':numpy.zeros(n_products, dtype='int64'),
+		}
+	history['product_aisle'][row_product] = row_aisle
+	history['product_department'][row_product] = row_department
+	numpy.maximum.at(history['product_order_number'], row_product, big_group['order_number'].values)
+	numpy.maximum.at(history['product_target'], row_product, big_group['target'].values)
+
+	for level, ids, row_ids in [('products', product_ids, row_product), ('aisles', aisle_ids, row_aisle), ('departments', department_ids, row_department)]:
+		history['n_'+level] = len(ids)
+		if bitmaps:
+			present = numpy.zeros((n_orders, len(ids)), dtype=bool)
+			present[row_order, row_ids] = True
+			history['present_'+level] = present
+	return history
+
+def walk_presence(present, history, track_orders=False):
+	'''
+	Walks the orders of an encoded history (see encode_history()) from the most recent one, as user_computations()
+	does, for the products, aisles or departments of a presence bitmap.
+	Displacements (days between two orders containing the item) are kept as a running sum and count.
+	Returns the support, days since last seen and average displacement of every item, and with track_orders
+	also the orders since last seen and the reorder streak.
+	'''
+	n = present.shape[1]
+	since = numpy.zeros(n)
+	support = numpy.zeros(n)
+	disp_sum, disp_count = numpy.zeros(n), numpy.zeros(n, dtype='int64')
+	days_since, orders_since = numpy.full(n, numpy.nan), numpy.full(n, numpy.nan)
+	seen = numpy.zeros(n, dtype=bool)
+	streak = numpy.zeros(n, dtype='int64')
+	order_num_max = history['order_num_max']
+
+	for k in range(present.shape[0]):
+		days = history['order_days'][k]
+		if history['in_target'][k]:
+			#the train/test order only moves the clock
+			since += days
+			continue
+		here = present[k]
+		support[here] += 1
+		valid = here & ~numpy.isnan(since)
+		disp_sum[valid] += since[valid]
+		disp_count[valid] += 1
+
+		first = here & ~seen
+		days_since[first] = since[first]
+		seen |= here
+		if track_orders:
+			orders_since[first] = order_num_max-history['order_number'][k]
+			streak[here & (streak==order_num_max-history['order_number'][k]-1)] += 1
+
+		since[~here] += days
+		since[here] = days
+
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		avg_disp = numpy.round(disp_sum/disp_count, 2)
+	return support, days_since, avg_disp, orders_since, streak
+
+def walk_orders(order_start, row_items, n_items, order_days, in_target, order_number, order_num_max):
+	'''
+	The order walk of walk_presence() as plain loops over the CSR arrays of encode_history() (row_items is one of
+	row_product, row_aisle or row_department), for compiling with numba (see numba_walk()).
+	Returns the support, days since last seen, displacement sum and count, orders since last seen and streak of every item.
+	'''
+	since = numpy.zeros(n_items)
+	support = numpy.zeros(n_items)
+	disp_sum, disp_count = numpy.zeros(n_items), numpy.zeros(n_items, dtype=numpy.int64)
+	days_since, orders_since = numpy.full(n_items, numpy.nan), numpy.full(n_items, numpy.nan)
+	seen = numpy.zeros(n_items, dtype=numpy.bool_)
+	streak = numpy.zeros(n_items, dtype=numpy.int64)
+	mark = numpy.full(n_items, -1, dtype=numpy.int64)
+
+	for k in range(len(order_days)):
+		days = order_days[k]
+		if in_target[k]:
+			for p in range(n_items):
+				since[p] += days
+			continue
+		for r in range(order_start[k], order_start[k+1]):
+			mark[row_items[r]] = k
+		for p in range(n_items):
+			if mark[p]==k:
+				support[p] += 1
+				if not numpy.isnan(since[p]):
+					disp_sum[p] += since[p]
+					disp_count[p] += 1
+				if not seen[p]:
+					seen[p] = True
+					days_since[p] = since[p]
+					orders_since[p] = order_num_max-order_number[k]
+				if streak[p]==order_num_max-order_number[k]-1:
+					streak[p] += 1
+				since[p] = days
+			else:
+				since[p] += days
+	return support, days_since, disp_sum, disp_count, orders_since, streak
+
+def numba_walk():
+	'''
+	Returns walk_orders() compiled by numba (compiled on first use, and cached on disk), or None if numba is not installed.
+	'''
+	global compiled_walk
+	if compiled_walk is None:
+		try:
+			import numba
+		except ImportError:
+			compiled_walk = False
+		else:
+			compiled_walk = numba.njit(cache=True)(walk_orders)
+	return compiled_walk or None
+
+def walk_level(level, history, kernel=None, track_orders=False):
+	'''
+	Walks the orders of history for its products, aisles or departments (level) with the compiled kernel
+	(see numba_walk()), or with walk_presence() if kernel is None. Both return the same values.
+	'''
+	if kernel is None:
+		return walk_presence(history['present_'+level], history, track_orders)
+	row_items = history[{'products':'row_product', 'aisles':'row_aisle', 'departments':'row_department'}[level]]
+	support, days_since, disp_sum, disp_count, orders_since, streak = kernel(history['order_start'], row_items, history['n_'+level],
+			history['order_days'], history['in_target'], history['order_number'], history['order_num_max'])
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		avg_disp = numpy.round(disp_sum/disp_count, 2)
+	return support, days_since, avg_disp, orders_since, streak
 
 def user_computations(big_group):
     '''
     Takes a subset of the new dataframe created above (all rows for a given user_id), 
     computes relevant information for each unique product_id,
-    and returns a dictionary with 
-            keys: product_id 
-            values: ['order_number', 'days_since_prod','days_since_aisle','days_since_department','order_aisle_displacement','orders_since_prod','avg_prod_disp','avg_aisle_disp','avg_dept_disp','prod_aisle_ratio','prod_dept_ratio', 'streak_length', 'target']
+    and returns a dataframe with a row per product_id and the columns
+            ['order_number', 'days_since_prod','days_since_aisle','days_since_department','order_aisle_displacement','orders_since_prod','avg_prod_disp','avg_aisle_disp','avg_dept_disp','prod_support', 'aisle_support', 'dept_support', 'streak_length', 'target']
+    The user's history is encoded as integer arrays (see encode_history()) and walked one order at a time,
+    by a compiled kernel or over presence bitmaps, depending on ORDER_WALK.
     Information about these engineered features can be found in the data dictionary.
     '''
+    kernel = numba_walk() if ORDER_WALK=='numba' else None
+    history = encode_history(big_group, bitmaps=kernel is None)
 
-    user_dict = {}
-    for product_id, group in big_group.groupby('product_id'):
-        #set up initial values to retain/update as we loop
-        user_dict[product_id] = {
-                            'order_number':max(group['order_number']),
-                            'aisle_id':max(group['aisle_id']), 
-                            'department_id':max(group['department_id']),
-                            'days_since_prod':None,
-                            'orders_since_prod':None,
-                            'days_since_aisle':None,
-                            'days_since_department':None,
-                            'prod_ord_num':None, 
-                            'aisle_ord_num':None,
-                            'product_displacements':[],
-                            'aisle_displacements':[],
-                            'dept_displacements':[],
-                            'prod_days':0, 
-                            'aisle_days':0, 
-                            'dept_days':0, 
-                            'streak_length':0,
-                            'prod_support':0.,
-                            'aisle_support':0.,
-                            'dept_support':0.,
-                            'target':max(group['target'])
-                                }
-    
-    order_num_max = max(group['order_number_max'])
-    
-    #iterate through orders, starting with most recent
-    for order_number, group in big_group.groupby('order_number', sort=False):
-        try:
-            days = max(group['days_since_prior_order'])
-        except:
-            continue
-        
-        if 'train' in group['eval_set'].values or 'test' in group['eval_set'].values:
-            #we're on the most recent order, just getting started in the loop
-            
-            for product_id in user_dict:
-                user_dict[product_id]['prod_days']+=days
-                user_dict[product_id]['aisle_days']+=days
-                user_dict[product_id]['dept_days']+=days
-                
-            continue
-
-        # get sets of products, aisles, and departments that occur in the order in consideration
-        products = set(group['product_id'])
-        aisles = set(group['aisle_id'])
-        depts = set(group['department_id'])
-        
-        for product_id in user_dict:
-            if product_id in products:
-                #the current order contains the product! 
-                user_dict[product_id]['prod_support'] += 1
-                
-                #append days since product to maintain average product displacement (in days)
-                user_dict[product_id]['product_displacements'] += [user_dict[product_id]['prod_days']]
-                
-                # if this is the first time the product has been in the order
-                if user_dict[product_id]['days_since_prod']==None:
-                    #track the days/orders since prior product order
-                    #AKA the number of days/orders between the test/train order and the user last ordering the product
-                    user_dict[product_id]['days_since_prod'] = user_dict[product_id]['prod_days']
-                    user_dict[product_id]['orders_since_prod'] = order_num_max-order_number
-                    
-                # check days since product - num orders
-                if user_dict[product_id]['prod_ord_num']==None:
-                    #track the orders since prior order, AKA the number of orders between the test/train order and the user last ordering the product
-                    user_dict[product_id]['prod_ord_num'] = order_number
-
-                # check for streak and update
-                if order_num_max-order_number-1==user_dict[product_id]['streak_length']:
-                    user_dict[product_id]['streak_length'] += 1
-
-                #reset prod_days offset for next iteration
-                user_dict[product_id]['prod_days'] = days
-            else:
-                #product was not in order, increment prod_days and continue to next product
-                user_dict[product_id]['prod_days'] += days
-
-
-            if user_dict[product_id]['aisle_id'] in aisles:
-                #the current order contains the aisle! 
-                user_dict[product_id]['aisle_support'] += 1
-                
-                # append days since aisle                                 
-                user_dict[product_id]['aisle_displacements'] += [user_dict[product_id]['aisle_days']]
-                
-                # if this is the first time the aisle has been in the order
-                if user_dict[product_id]['days_since_aisle']==None:
-                    user_dict[product_id]['days_since_aisle'] = user_dict[product_id]['aisle_days']
-                    
-                # check days since product - num orders
-                if user_dict[product_id]['aisle_ord_num']==None:
-                    user_dict[product_id]['aisle_ord_num'] = order_number
-
-                #reset aisle_days offset
-                user_dict[product_id]['aisle_days'] = days
-            else:
-                user_dict[product_id]['aisle_days'] += days
-
-            if user_dict[product_id]['department_id'] in depts:
-                #the current order contains the department! 
-                user_dict[product_id]['dept_support'] += 1
-
-                # append days since dept
-                user_dict[product_id]['dept_displacements'] += [user_dict[product_id]['dept_days']]
-                
-                # if this is the first time the department has been in the order
-                if user_dict[product_id]['days_since_department']==None:
-                    user_dict[product_id]['days_since_department'] = user_dict[product_id]['dept_days']
-
-                #reset aisle_days offset
-                user_dict[product_id]['dept_days'] = days
-            else:
-                user_dict[product_id]['dept_days'] += days
-        
-        #increment days, and loop again
-        days = max(group['days_since_prior_order'])
-        
-    # take averages and reorganize/cleanup
-    for product_id in user_dict:
-        user_dict[product_id]['avg_prod_disp'] = round(numpy.nanmean(user_dict[product_id]['product_displacements']),2)
-        user_dict[product_id]['avg_aisle_disp'] = round(numpy.nanmean(user_dict[product_id]['aisle_displacements']),2)
-        user_dict[product_id]['avg_dept_disp'] = round(numpy.nanmean(user_dict[product_id]['dept_displacements']),2)
-        
-        user_dict[product_id]['order_aisle_displacement'] = int(abs(user_dict[product_id]['aisle_ord_num']-user_dict[product_id]['prod_ord_num'])) if user_dict[product_id]['aisle_ord_num']!=None and user_dict[product_id]['prod_ord_num']!=None else None
-        user_dict[product_id]['order_aisle_displacement'] = round(numpy.nanmean(user_dict[product_id]['product_displacements']),2)
-        user_dict[product_id]['order_aisle_displacement']
-		
-        user_dict[product_id] = {k: user_dict[product_id][k] for k in ['order_number', 'days_since_prod','days_since_aisle','days_since_department','order_aisle_displacement','orders_since_prod','avg_prod_disp','avg_aisle_disp','avg_dept_disp','prod_support', 'aisle_support', 'dept_support', 'streak_length', 'target']}
-        
-    return pd.DataFrame.from_dict(user_dict).T.reset_index().rename(columns={'index':'product_id'})
+    prod_support, days_since_prod, avg_prod_disp, orders_since_prod, streak_length = walk_level('products', history, kernel, track_orders=True)
+    aisle_support, days_since_aisle, avg_aisle_disp = walk_level('aisles', history, kernel)[:3]
+    dept_support, days_since_department, avg_dept_disp = walk_level('departments', history, kernel)[:3]
+
+    # aisle and department values are shared by the products in them
+    aisle, dept = history['product_aisle'], history['product_department']
+    return pd.DataFrame({
+                        'product_id':history['product_ids'],
+                        'order_number':history['product_order_number'],
+                        'days_since_prod':days_since_prod,
+                        'days_since_aisle':days_since_aisle[aisle],
+                        'days_since_department':days_since_department[dept],
+                        'order_aisle_displacement':avg_prod_disp,
+                        'orders_since_prod':orders_since_prod,
+                        'avg_prod_disp':avg_prod_disp,
+                        'avg_aisle_disp':avg_aisle_disp[aisle],
+                        'avg_dept_disp':avg_dept_disp[dept],
+                        'prod_support':prod_support,
+                        'aisle_support':aisle_support[aisle],
+                        'dept_support':dept_support[dept],
+                        'streak_length':streak_length,
+                        'target':history['product_target'],
+                            })
 
-def generate_new_df():
+# columns of the files saved by compute_chunk(), with either engine
+CHUNK_COLUMNS = ['user_id', 'product_id', 'order_number', 'days_since_prod','days_since_aisle','days_since_department',
+				'order_aisle_displacement','orders_since_prod','avg_prod_disp','avg_aisle_disp','avg_dept_disp',
+				'prod_support', 'aisle_support', 'dept_support', 'streak_length', 'target']
+
+def _segment_features(events, key, timeline):
 	'''
-	Merges the competition-provided datasets (orders, order_products__train, and order_products__prior)
-	and saves instacart_merged_new.csv.
+	Reduces the prior (user_id, key, timeline position) events to one row per (user_id, key), using the
+	same days counters as user_computations: each displacement is the sum of days_since_prior_order
+	between the previous order containing the key (or the user's newest order) and the current one.
 	'''
-	#check if file already exists
-	filename = 'instacart_merged_new.csv'
-	if os.path.isfile(filename):
-		return
-			
-	# read in data
-	orders = pd.read_csv('orders.csv')
-	train = pd.read_csv('order_products__train.csv')
-	prior = pd.read_csv('order_products__prior.csv')
+	events = events.drop_duplicates()
+	events = events.iloc[numpy.lexsort((events['pos'].values, events[key].values, events['user_id'].values))]
+
+	users = events['user_id'].values
+	keys = events[key].values
+	pos = events['pos'].values
+
+	# segment boundaries, one segment per (user, key), orders newest first inside each segment
+	first = numpy.ones(len(events), dtype=bool)
+	first[1:] = (users[1:]!=users[:-1]) | (keys[1:]!=keys[:-1])
+	starts = numpy.flatnonzero(first)
+	support = numpy.diff(numpy.append(starts, len(events)))
+
+	# position the days counter was last reset at: the previous order with the key, else the user's newest order
+	prev = numpy.empty_like(pos)
+	prev[1:] = pos[:-1]
+	prev[first] = timeline['user_start'].values[pos[first]]
+
+	elapsed = timeline['elapsed'].values
+	missing = timeline['missing'].values
+	disp = elapsed[pos]-elapsed[prev]
+	disp[missing[pos]-missing[prev] > 0] = numpy.nan
+
+	valid = ~numpy.isnan(disp)
+	disp_sum = numpy.add.reduceat(numpy.where(valid, disp, 0.), starts) if len(starts) else numpy.zeros(0)
+	disp_count = numpy.add.reduceat(valid.astype(numpy.int64), starts) if len(starts) else numpy.zeros(0, dtype=numpy.int64)
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		avg_disp = numpy.round(disp_sum/disp_count, 2)
+
+	result = pd.DataFrame({'user_id':users[starts], key:keys[starts], 'support':support.astype(float),
+						'days_since':disp[starts], 'avg_disp':avg_disp})
+
+	if key=='product_id':
+		# streak: leading run of orders order_number_max-1, order_number_max-2, ... containing the product
+		order_number = timeline['order_number'].values[pos]
+		rank = numpy.arange(len(events))-numpy.repeat(starts, support)
+		in_streak = order_number==timeline['order_number_max'].values[pos]-1-rank
+		result['streak_length'] = numpy.add.reduceat(in_streak.astype(numpy.int64), starts) if len(starts) else 0
+		result['orders_since_prod'] = timeline['order_number_max'].values[pos[starts]]-order_number[starts]
+
+	return result
+
+def vectorized_computations(new):
+	'''
+	Columnar equivalent of new.groupby('user_id').apply(user_computations), computing the same
+	per user-product features for all users in new at once.
+	Each user's orders are laid out newest first in a single timeline, the days counters of user_computations
+	become prefix sums over that timeline, and supports, displacements and streaks become
+	segment reductions over the sorted prior rows.
+	Returns a dataframe with one row per (user_id, product_id), sorted by user_id then product_id.
+	'''
+	# one row per (user, order), newest order first within each user
+	timeline = new.groupby(['user_id', 'order_number'])['days_since_prior_order'].max().reset_index()
+	timeline = timeline.sort_values(['user_id', 'order_number'], ascending=[True, False]).reset_index(drop=True)
+	timeline = timeline.join(new.groupby('user_id')['order_number_max'].max(), on='user_id')
+
+	# days elapsed before reaching each order, and how many missing day counts were crossed doing so
+	days = timeline['days_since_prior_order'].values.astype(float)
+	missing = numpy.isnan(days)
+	days = numpy.where(missing, 0., days)
+	timeline['elapsed'] = numpy.cumsum(days)-days
+	timeline['missing'] = numpy.cumsum(missing)-missing
+
+	user_change = numpy.ones(len(timeline), dtype=bool)
+	user_change[1:] = timeline['user_id'].values[1:]!=timeline['user_id'].values[:-1]
+	starts = numpy.flatnonzero(user_change)
+	timeline['user_start'] = numpy.repeat(starts, numpy.diff(numpy.append(starts, len(timeline))))
+
+	# locate every prior row's order in the timeline
+	span = int(timeline['order_number'].max())+1
+	timeline_key = timeline['user_id'].values.astype(numpy.int64)*span+(span-timeline['order_number'].values)
+	prior = new[new['eval_set']=='prior']
+	prior_key = prior['user_id'].values.astype(numpy.int64)*span+(span-prior['order_number'].values.astype(numpy.int64))
+	prior = pd.DataFrame({'user_id':prior['user_id'].values, 'product_id':prior['product_id'].values,
+						'aisle_id':prior['aisle_id'].values, 'department_id':prior['department_id'].values,
+						'pos':numpy.searchsorted(timeline_key, prior_key)})
+
+	prod = _segment_features(prior[['user_id', 'product_id', 'pos']], 'product_id', timeline)
+	aisle = _segment_features(prior[['user_id', 'aisle_id', 'pos']], 'aisle_id', timeline)
+	dept = _segment_features(prior[['user_id', 'department_id', 'pos']], 'department_id', timeline)
+
+	# every product the user has a row for, with its most recent order (including the train/test order)
+	joined = new.groupby(['user_id', 'product_id'])[['order_number', 'aisle_id', 'department_id', 'target']].max().reset_index()
+
+	joined = joined.merge(prod.rename(columns={'support':'prod_support', 'days_since':'days_since_prod', 'avg_disp':'avg_prod_disp'}),
+						on=['user_id', 'product_id'], how='left')
+	joined = joined.merge(aisle.rename(columns={'support':'aisle_support', 'days_since':'days_since_aisle', 'avg_disp':'avg_aisle_disp'}),
+						on=['user_id', 'aisle_id'], how='left')
+	joined = joined.merge(dept.rename(columns={'support':'dept_support', 'days_since':'days_since_department', 'avg_disp':'avg_dept_disp'}),
+						on=['user_id', 'department_id'], how='left')
+
+	for col in ['prod_support', 'aisle_support', 'dept_support', 'streak_length']:
+		joined[col] = joined[col].fillna(0)
+	joined['streak_length'] = joined['streak_length'].astype(int)
+
+	# matches user_computations, which reports the average product displacement here
+	joined['order_aisle_displacement'] = joined['avg_prod_disp']
+
+	return joined[CHUNK_COLUMNS]
+
+# the product index saved by generate_new_df() (see new_product_index()), and its copy in Feature_state
+PRODUCT_INDEX = 'product_index'
+# time_period of each hour of the day: late (19:00-4:59), morning (5:00-12:59) or afternoon (13:00-18:59)
+TIME_PERIODS = ['late', 'morning', 'afternoon']
+HOUR_PERIOD = numpy.array([0]*5+[1]*8+[2]*6+[0]*5, dtype='uint8')
+
+def new_product_index(products):
+	'''
+	Returns an empty product index for products (product_id, aisle_id, department_id), a dict of arrays:
+	the sorted product_ids, aisle_ids and department_ids, whose positions are the dense codes of those ids,
+	each product's aisle and department codes, and per-product counts of prior order rows (orders), reorders,
+	and rows by time_period (n_products x 3) and by order_dow (n_products x 7), filled by count_products().
+	'''
+	products = products.drop_duplicates('product_id').sort_values('product_id')
+	aisle_ids, product_aisle = numpy.unique(products['aisle_id'].values, return_inverse=True)
+	department_ids, product_department = numpy.unique(products['department_id'].values, return_inverse=True)
+	n_products = len(products)
+	return {'product_ids':products['product_id'].values.astype('int32'),
+			'aisle_ids':aisle_ids.astype('int32'), 'department_ids':department_ids.astype('int32'),
+			'product_aisle':product_aisle.astype('int32'), 'product_department':product_department.astype('int32'),
+			'orders':numpy.zeros(n_products, dtype='int32'), 'reorders':numpy.zeros(n_products, dtype='int32'),
+			'time_periods':numpy.zeros((n_products, len(TIME_PERIODS)), dtype='int32'),
+			'dows':numpy.zeros((n_products, 7), dtype='int32')}
+
+def product_codes(index, product_id):
+	'''
+	Returns the dense codes of product_id in index, -1 for products not in it.
+	'''
+	product_ids = index['product_ids']
+	codes = numpy.minimum(numpy.searchsorted(product_ids, product_id), len(product_ids)-1)
+	return numpy.where(product_ids[codes]==product_id, codes, -1)
+
+def product_lookup(index, level):
+	'''
+	Returns an array of the aisle_id or department_id (level) of every product_id, to look them up by id.
+	'''
+	ids = index[level+'_ids'][index['product_'+level]]
+	return index_array(index['product_ids'], ids, 0, 'int32')
+
+def count_products(index, prior):
+	'''
+	Adds prior order rows (product_id, reordered, order_hour_of_day, order_dow) to the counts of index, in place.
+	'''
+	codes = product_codes(index, prior['product_id'].values)
+	if (codes<0).any():
+		raise ValueError('Products missing from products.csv: {}'.format(numpy.unique(prior['product_id'].values[codes<0])[:10]))
+	n_products = len(index['product_ids'])
+	period = HOUR_PERIOD[prior['order_hour_of_day'].values.astype('int64')]
+	index['orders'] += numpy.bincount(codes, minlength=n_products).astype('int32')
+	index['reorders'] += numpy.bincount(codes, weights=prior['reordered'].values, minlength=n_products).astype('int32')
+	index['time_periods'] += numpy.bincount(codes*3+period, minlength=n_products*3).reshape(n_products, 3).astype('int32')
+	index['dows'] += numpy.bincount(codes*7+prior['order_dow'].values.astype('int64'), minlength=n_products*7).reshape(n_products, 7).astype('int32')
+
+def save_product_index(index, name=PRODUCT_INDEX):
+	filename = name + '.npz'
+	with open(filename + '.tmp', 'wb') as f:
+		numpy.savez(f, **index)
+	os.replace(filename + '.tmp', filename)
+	count_io(bytes_written=os.path.getsize(filename))
+
+def load_product_index(name=PRODUCT_INDEX):
+	filename = name + '.npz'
+	with numpy.load(filename) as arrays:
+		index = {key:arrays[key] for key in arrays.files}
+	count_io(bytes_read=os.path.getsize(filename))
+	return index
+
+def product_features(final, index):
+	'''
+	Adds the product-level features of index to final, rows with product_id, target_hour and target_dow, by array
+	indexing: the product's reorder rate over the prior orders, and its time-of-day and day-of-week lifts, the share of
+	the product's prior rows in the time_period (or order_dow) of the user's current train/test order over the share
+	of all prior rows in it. Every row of a user takes the same order, whatever its target, so train and test rows match.
+	'''
+	codes = product_codes(index, final['product_id'].values)
+	known = codes>=0
+	codes = numpy.where(known, codes, 0)
+	orders = numpy.where(known, index['orders'][codes], 0).astype('float64')
+	period = HOUR_PERIOD[final['target_hour'].values.astype('int64')]
+	dow = final['target_dow'].values.astype('int64')
+
+	period_share = index['time_periods'].sum(axis=0)/float(index['orders'].sum())
+	dow_share = index['dows'].sum(axis=0)/float(index['orders'].sum())
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		final['prod_reorder_rate'] = index['reorders'][codes]/orders
+		final['tod_lift'] = index['time_periods'][codes, period]/orders/period_share[period]
+		final['dow_lift'] = index['dows'][codes, dow]/orders/dow_share[dow]
+	return final
+
+# rough peak memory per order_products row while a chunk is being merged, used to size chunks from a memory budget
+ROW_BYTES = 400
+# rough size of an order_products csv row, and memory per row for the distinct user-product pairs collected from them
+# (at most one pair per row, held about three times over while they are deduplicated)
+CSV_ROW_BYTES = 18
+PAIR_BYTES = 24
+# smallest chunk a memory budget may leave room for
+MIN_CHUNK_ROWS = 10000
+
+def index_array(index, values, fill, dtype):
+	'''
+	Returns an array a with a[index] = values, filled with fill elsewhere, to look values up by id.
+	'''
+	index = numpy.asarray(index)
+	lookup = numpy.full(index.max()+1, fill, dtype=dtype)
+	lookup[index] = values
+	return lookup
+
+def read_chunks(filename, chunksize, usecols=None):
+	'''
+	Yields filename in dataframes of chunksize rows, or as a single dataframe if chunksize is None.
+	'''
+	dtype = {col:('int32' if col in ('order_id', 'product_id') else 'int16') for col in ['order_id', 'product_id', 'add_to_cart_order', 'reordered']}
+	count_io(bytes_read=os.path.getsize(filename))
+	if chunksize is None:
+		chunks = [pd.read_csv(filename, usecols=usecols, dtype=dtype)]
+	else:
+		chunks = pd.read_csv(filename, usecols=usecols, dtype=dtype, chunksize=chunksize)
+	for chunk in chunks:
+		count_io(rows_in=len(chunk))
+		yield chunk
+
+def read_input(filename, **kwargs):
+	'''
+	pd.read_csv for the competition-provided files, counting the rows and bytes read toward the current stage.
+	'''
+	df = pd.read_csv(filename, **kwargs)
+	count_io(rows_in=len(df), bytes_read=os.path.getsize(filename))
+	return df
+
+def merge_rows(rows, lookups):
+	'''
+	Joins order_products rows (order_id, product_id, add_to_cart_order, reordered) with the order, user and
+	product lookups built in generate_new_df(), returning them in the layout of instacart_merged_new.
+	'''
+	order_id = rows['order_id'].values
+	product_id = rows['product_id'].values
+	user_id = lookups['user_id'][order_id]
+	eval_set = lookups['eval_set'][order_id]
+
+	return pd.DataFrame({
+		'order_id':order_id,
+		'product_id':product_id,
+		'user_id':user_id,
+		'order_number':lookups['order_number'][order_id],
+		'add_to_cart_order':rows['add_to_cart_order'].values.astype('float32'),
+		'reordered':rows['reordered'].values.astype('float32'),
+		'days_since_prior_order':lookups['days_since_prior_order'][order_id],
+		'order_dow':lookups['order_dow'][order_id],
+		'order_hour_of_day':lookups['order_hour_of_day'][order_id],
+		'eval_set':pd.Categorical.from_codes(eval_set, dtype=SCHEMA['eval_set']),
+		'order_number_max':lookups['order_number_max'][user_id],
+		'ord_size':lookups['ord_size'][order_id],
+		'aisle_id':lookups['aisle_id'][product_id],
+		'department_id':lookups['department_id'][product_id],
+		# create target, based on which order the product was in
+		'target':eval_set.astype('uint8'),
+		})
 
-	#merge with orders
-	train = train.merge(orders, on='order_id', how='left')
-	prior = prior.merge(orders, on='order_id', how='left')
+@instrumented
+def generate_new_df(memory_budget=None, engine='pandas'):
+	'''
+	Merges the competition-provided datasets (orders, order_products__train, order_products__prior and products)
+	and saves instacart_merged_new.
+	Also saves user_costs, each user's number of orders and distinct products and their product, the
+	number of order-product steps user_computations takes for that user, used by make_chunks() to balance chunks,
+	and the product index (see new_product_index()), counted from the prior rows as they are written.
+	The order_products files are streamed in chunks, and every chunk is joined against in-memory lookups
+	of orders (indexed by order_id), users and products, so the ~32M prior rows are never loaded at once.
+	memory_budget (in bytes), less the lookups and an estimate of the distinct user-product pairs, bounds the chunk size,
+	and a budget without room for MIN_CHUNK_ROWS rows raises a ValueError; by default each file is read in a single chunk.
+	engine='sql' runs the joins in an embedded database instead (see sql_generate_new_df()).
+	'''
+	#check if the file is up to date with the input files
+	key = stage_key('generate_new_df', [file_digest(filename) for filename in INPUT_FILES], engine)
+	if cache_hit('instacart_merged_new', key):
+		return
+	files = [artifact_path('instacart_merged_new'), artifact_path('user_costs'), PRODUCT_INDEX+'.npz']
+	if engine=='sql':
+		sql_generate_new_df(memory_budget)
+		#last_merges(engine='sql') reads the database
+		files.append(SQL_DATABASE)
+	else:
+		pandas_generate_new_df(memory_budget)
+	cache_store('instacart_merged_new', key, files)
 
-	#make new dataframe
-	new = train.append(prior, ignore_index=True)
+def pandas_generate_new_df(memory_budget=None):
+	'''
+	The engine='pandas' version of generate_new_df().
+	'''
+	# read in the lookups
+	orders = read_input('orders.csv', dtype={'order_id':'int32', 'user_id':'int32', 'order_number':'int16',
+										'order_dow':'uint8', 'order_hour_of_day':'uint8', 'days_since_prior_order':'float32'})
+	orders['eval_set'] = orders['eval_set'].astype(SCHEMA['eval_set']).cat.codes
+	index = new_product_index(read_input('products.csv', usecols=['product_id', 'aisle_id', 'department_id']))
 
-	del train
-	del prior
+	order_id = orders['order_id'].values
+	lookups = {col:index_array(order_id, orders[col].values, 0, orders[col].dtype)
+			for col in ['user_id', 'order_number', 'order_dow', 'order_hour_of_day', 'eval_set']}
+	lookups['days_since_prior_order'] = index_array(order_id, orders['days_since_prior_order'].values, numpy.nan, 'float32')
+	lookups['aisle_id'] = product_lookup(index, 'aisle')
+	lookups['department_id'] = product_lookup(index, 'department')
 
-	#get unique set of user, product combinations, where the user_id is in the test set (unknowns to predict)
-	unique = new[new['user_id'].isin(orders[orders['eval_set']=='test']['user_id'])].drop_duplicates(['user_id', 'product_id'])[['user_id', 'product_id']]
-	#merge with orders
-	unique = unique.merge(orders[orders['eval_set']=='test'], on='user_id', how='left')
+	# each user's maximum number of orders (including the train/test orders)
+	max_orders = orders.groupby('user_id')['order_number'].max()
+	lookups['order_number_max'] = index_array(max_orders.index.values, max_orders.values, 0, 'int16')
 
-	del orders
+	# each user's test order, if any
+	test = orders[orders['eval_set']==SCHEMA['eval_set'].categories.get_loc('test')]
+	test_order = numpy.zeros(len(lookups['order_number_max']), dtype='int32')
+	test_order[test['user_id'].values] = test['order_id'].values
+	del orders, test
 
-	#append to new dataframe
-	new = new.append(unique, ignore_index=True)
+	filenames = ['order_products__train.csv', 'order_products__prior.csv']
+	pair_bytes = PAIR_BYTES*sum(os.path.getsize(filename) for filename in filenames)/CSV_ROW_BYTES
+	fixed = sum(lookup.nbytes for lookup in lookups.values())+test_order.nbytes+pair_bytes
+	if memory_budget is not None and memory_budget<fixed+MIN_CHUNK_ROWS*ROW_BYTES:
+		raise ValueError('memory_budget of {} bytes is too small, the lookups and user-product pairs need about {} bytes and every {} rows merged another {}'.format(
+			int(memory_budget), int(fixed), MIN_CHUNK_ROWS, MIN_CHUNK_ROWS*ROW_BYTES))
+	chunksize = None if memory_budget is None else int((memory_budget-fixed)/ROW_BYTES)
 
-	#select a few relevant columns and re-arrange
-	new = new[['order_id', 'product_id', 'user_id', 'order_number', 'add_to_cart_order', 'reordered', 'days_since_prior_order', 'eval_set']]
+	# first pass: each order's number of items (meaningless for the test orders), and the
+	# unique set of user, product combinations
+	ord_size = numpy.full(len(lookups['user_id']), numpy.nan, dtype='float32')
+	user_pairs, pending = numpy.zeros(0, dtype='int64'), []
+	span = len(lookups['aisle_id'])
+	for filename in filenames:
+		for rows in read_chunks(filename, chunksize, usecols=['order_id', 'product_id', 'add_to_cart_order']):
+			sizes = rows.groupby('order_id')['add_to_cart_order'].max()
+			numpy.fmax.at(ord_size, sizes.index.values, sizes.values.astype('float32'))
 
-	#self-join to get each user's maximum number of orders (including the train/test orders)
-	new = new.join(new.groupby('user_id')['order_number'].max(), on='user_id', how='left', rsuffix='_max')
+			user_id = lookups['user_id'][rows['order_id'].values]
+			pending.append(numpy.unique(user_id.astype('int64')*span+rows['product_id'].values))
+			# deduplicate only once the new pairs outnumber the distinct ones so far, so the pass stays linear in the chunks
+			if sum(len(pairs) for pairs in pending)>len(user_pairs):
+				user_pairs, pending = numpy.unique(numpy.concatenate([user_pairs]+pending)), []
+	user_pairs = numpy.unique(numpy.concatenate([user_pairs]+pending))
+	del pending
+	lookups['ord_size'] = ord_size
 
-	#self-join to get each order's number of items (meaningless for the train/test orders)
-	new = new.join(new.groupby('order_id')['add_to_cart_order'].max(), on='order_id', how='left', rsuffix='_max')
-	new.rename(columns={'add_to_cart_order_max':'ord_size'}, inplace=True)
+	# the combinations where the user is in the test set (unknowns to predict)
+	test_pairs = user_pairs[test_order[user_pairs//span]>0]
 
-	#merge with products to get aisle_id and department_id
-	products = pd.read_csv('products.csv')
-	new = new.merge(products[['product_id', 'aisle_id', 'department_id']], left_on='product_id', right_on='product_id', how='left')
-	del products
+	# each user's cost estimate for the chunk scheduler
+	num_products = numpy.bincount(user_pairs//span, minlength=len(test_order))
+	costs = pd.DataFrame({'user_id':numpy.nonzero(num_products)[0]})
+	costs['num_orders'] = lookups['order_number_max'][costs['user_id'].values]
+	costs['num_products'] = num_products[costs['user_id'].values]
+	costs['cost'] = costs['num_orders'].astype('int64')*costs['num_products']
+	save_frame(costs, 'user_costs')
+	del user_pairs, num_products, costs
 
-	# create target, based on which order the product was in
-	new['target'] = 0
-	new.loc[new['eval_set'] == 'train', 'target'] = 1
-	new.loc[new['eval_set'] == 'test', 'target'] = 2
+	def pieces():
+		# one row per test user and product, in the user's test order
+		step = chunksize or max(1, len(test_pairs))
+		for start in range(0, len(test_pairs), step):
+			pairs = test_pairs[start:start+step]
+			stubs = pd.DataFrame({'order_id':test_order[pairs//span], 'product_id':(pairs%span).astype('int32'),
+								'add_to_cart_order':numpy.nan, 'reordered':numpy.nan})
+			yield merge_rows(stubs, lookups)
 
-	#sort to get newest orders first
-	new.sort_values(['target', 'order_number'], ascending=[False, False], inplace=True)
+		# remove values where the product is FIRST ordered by the user in the train set
+		# we're only predicting re-orders, so no use training with products that have no history with that user
+		for rows in read_chunks('order_products__train.csv', chunksize):
+			yield merge_rows(rows[rows['reordered']!=0], lookups)
 
-	# remove values where the product is FIRST ordered by the user in the train set
-	# we're only predicting re-orders, so no use training with products that have no history with that user
-	new = new[~((new['target']==1) & (new['reordered']==0))]
+		for rows in read_chunks('order_products__prior.csv', chunksize):
+			rows = merge_rows(rows, lookups)
+			count_products(index, rows)
+			yield rows
 
 	#save
-	new.to_csv('instacart_merged_new.csv')
-	
-	
+	save_frames(pieces(), 'instacart_merged_new')
+	save_product_index(index)
+
+
+# embedded database used by engine='sql' in generate_new_df() and last_merges()
+SQL_DATABASE = 'instacart.sqlite'
+# rows per insert while loading the csv files, and per dataframe streamed out of the database
+SQL_CHUNKSIZE = 100000
+
+def sql_connect(memory_budget=None):
+	'''
+	Opens SQL_DATABASE, with its page cache bounded by memory_budget (in bytes, 256MB by default).
+	Sorts, groupings and temporary tables beyond that spill to temporary files.
+	'''
+	connection = sqlite3.connect(SQL_DATABASE)
+	connection.execute('PRAGMA journal_mode=OFF')
+	connection.execute('PRAGMA synchronous=OFF')
+	connection.execute('PRAGMA temp_store=FILE')
+	connection.execute('PRAGMA cache_size=-{}'.format(int((memory_budget or 2**28)/1024)))
+	return connection
+
+def sql_load_csv(connection, table, filename, usecols=None, **constants):
+	'''
+	Streams csv filename into table, SQL_CHUNKSIZE rows at a time, adding a column per keyword in constants.
+	'''
+	count_io(bytes_read=os.path.getsize(filename))
+	for rows in pd.read_csv(filename, usecols=usecols, chunksize=SQL_CHUNKSIZE):
+		count_io(rows_in=len(rows))
+		for col, value in constants.items():
+			rows[col] = value
+		rows.to_sql(table, connection, if_exists='append', index=False)
+
+def sql_frames(connection, query):
+	'''
+	Yields the result of query in dataframes of SQL_CHUNKSIZE rows.
+	'''
+	for rows in pd.read_sql_query(query, connection, chunksize=SQL_CHUNKSIZE):
+		yield rows
+
+def sql_merged_layout(rows):
+	'''
+	Converts rows of the merged table to the layout of instacart_merged_new (see merge_rows()).
+	'''
+	rows['eval_set'] = pd.Categorical(rows['eval_set'], dtype=SCHEMA['eval_set'])
+	rows['target'] = rows['eval_set'].cat.codes.astype('uint8')
+	return apply_schema(rows.astype({col:'float64' for col in ['add_to_cart_order', 'reordered', 'days_since_prior_order', 'ord_size']}))
+
+def sql_generate_new_df(memory_budget=None):
+	'''
+	The engine='sql' version of generate_new_df(): loads the competition files into SQL_DATABASE, joins them there
+	into a merged table, and streams that table out to instacart_merged_new, user_costs and the product index.
+	The rows come out in the order of the pandas engine, and with the same values.
+	Only one chunk of rows is ever held in memory, the database spills the rest to disk.
+	'''
+	if os.path.isfile(SQL_DATABASE):
+		os.remove(SQL_DATABASE)
+	connection = sql_connect(memory_budget)
+
+	sql_load_csv(connection, 'orders', 'orders.csv')
+	sql_load_csv(connection, 'products', 'products.csv', usecols=['product_id', 'aisle_id', 'department_id'])
+	# train rows first, so rowid follows the order the pandas engine writes them in
+	sql_load_csv(connection, 'order_products', 'order_products__train.csv', part=1)
+	sql_load_csv(connection, 'order_products', 'order_products__prior.csv', part=2)
+
+	connection.executescript('''
+		CREATE UNIQUE INDEX orders_id ON orders(order_id);
+		CREATE UNIQUE INDEX products_id ON products(product_id);
+
+		-- each order's number of items (meaningless for the test orders)
+		CREATE TABLE ord_size AS SELECT order_id, MAX(add_to_cart_order) AS ord_size FROM order_products GROUP BY order_id;
+		CREATE UNIQUE INDEX ord_size_id ON ord_size(order_id);
+
+		-- each user's maximum number of orders (including the train/test orders) and test order, if any
+		CREATE TABLE users AS SELECT user_id, MAX(order_number) AS order_number_max,
+			MAX(CASE WHEN eval_set='test' THEN order_id END) AS test_order FROM orders GROUP BY user_id;
+		CREATE UNIQUE INDEX users_id ON users(user_id);
+
+		CREATE TABLE user_products AS SELECT DISTINCT o.user_id, op.product_id
+			FROM order_products op JOIN orders o ON o.order_id=op.order_id;
+
+		-- one row per test user and product, in the user's test order, then the train rows with a reordered
+		-- product (no use training with products that have no history with that user), then the prior rows
+		CREATE TABLE merged_rows (order_id INTEGER, product_id INTEGER, add_to_cart_order REAL, reordered REAL);
+		INSERT INTO merged_rows SELECT u.test_order, up.product_id, NULL, NULL
+			FROM user_products up JOIN users u ON u.user_id=up.user_id
+			WHERE u.test_order IS NOT NULL ORDER BY up.user_id, up.product_id;
+		INSERT INTO merged_rows SELECT order_id, product_id, add_to_cart_order, reordered
+			FROM order_products WHERE part=1 AND reordered!=0 ORDER BY rowid;
+		INSERT INTO merged_rows SELECT order_id, product_id, add_to_cart_order, reordered
+			FROM order_products WHERE part=2 ORDER BY rowid;
+
+		CREATE TABLE merged AS SELECT r.order_id, r.product_id, o.user_id, o.order_number, r.add_to_cart_order, r.reordered,
+			o.days_since_prior_order, o.order_dow, o.order_hour_of_day, o.eval_set, u.order_number_max, s.ord_size,
+			p.aisle_id, p.department_id
+			FROM merged_rows r JOIN orders o ON o.order_id=r.order_id JOIN users u ON u.user_id=o.user_id
+			LEFT JOIN ord_size s ON s.order_id=r.order_id JOIN products p ON p.product_id=r.product_id
+			ORDER BY r.rowid;
+		DROP TABLE merged_rows;
+		-- make_chunks(engine='sql') reads the rows of one chunk's users at a time
+		CREATE INDEX merged_user ON merged(user_id);
+		''')
+
+	costs = pd.read_sql_query('''SELECT up.user_id, u.order_number_max AS num_orders, COUNT(*) AS num_products
+		FROM user_products up JOIN users u ON u.user_id=up.user_id GROUP BY up.user_id ORDER BY up.user_id''', connection)
+	costs['cost'] = costs['num_orders'].astype('int64')*costs['num_products']
+	save_frame(costs, 'user_costs')
+	del costs
+
+	index = new_product_index(read_input('products.csv', usecols=['product_id', 'aisle_id', 'department_id']))
+	def pieces():
+		for rows in sql_frames(connection, 'SELECT * FROM merged ORDER BY rowid'):
+			rows = sql_merged_layout(rows)
+			count_products(index, rows[rows['eval_set']=='prior'])
+			yield rows
+
+	save_frames(pieces(), 'instacart_merged_new')
+	save_product_index(index)
+	connection.close()
+
+def sql_partitions(chunks, memory_budget=None):
+	'''
+	Yields the rows of every chunk's users from the merged table of SQL_DATABASE (see sql_generate_new_df()),
+	one chunk at a time, in the layout and row order of a Merged_partitions file.
+	'''
+	if not os.path.isfile(SQL_DATABASE):
+		raise IOError('{} not found, run generate_new_df(engine=\'sql\') first'.format(SQL_DATABASE))
+	connection = sql_connect(memory_budget)
+	connection.execute('CREATE TEMP TABLE chunk_users (user_id INTEGER PRIMARY KEY, chunk INTEGER)')
+	connection.executemany('INSERT INTO chunk_users VALUES (?, ?)', [(int(user_id), i) for i in range(len(chunks)) for user_id in chunks[i]])
+
+	for i in range(len(chunks)):
+		#newest orders first, then in the order of instacart_merged_new
+		rows = pd.concat(sql_frames(connection, '''SELECT m.* FROM chunk_users c JOIN merged m ON m.user_id=c.user_id WHERE c.chunk={}
+			ORDER BY CASE m.eval_set WHEN 'prior' THEN 0 WHEN 'train' THEN 1 ELSE 2 END DESC, m.order_number DESC, m.rowid'''.format(i)),
+			ignore_index=True)
+		yield sql_merged_layout(rows)
+	connection.close()
+
 def chunkify(lst,n):
     return [lst[i::n] for i in range(n)]
-	
-def make_chunks():
+
+def balanced_chunks(costs, n, previous=None):
+	'''
+	Packs the users of costs (a dataframe with user_id and cost columns) into n chunks of about equal
+	total cost: the costliest users first, each into the chunk with the lowest total so far.
+	With previous (an earlier list of n chunks), the users already in one of them stay in it, so a chunk only
+	changes when its own users' rows do, and only the new users are packed; users not in costs are dropped.
+	Returns the list of chunks (lists of user_ids) and an array of their total costs.
+	'''
+	costs = costs.sort_values(['cost', 'user_id'], ascending=[False, True])
+	chunks = [[] for i in range(n)]
+	heap = [(0, i) for i in range(n)]
+	if previous is not None:
+		cost = dict(zip(costs['user_id'].tolist(), costs['cost'].tolist()))
+		chunks = [[user_id for user_id in chunk if user_id in cost] for chunk in previous]
+		heap = [(sum(cost[user_id] for user_id in chunks[i]), i) for i in range(n)]
+		heapq.heapify(heap)
+		placed = set(user_id for chunk in chunks for user_id in chunk)
+		costs = costs[~costs['user_id'].isin(placed)]
+	for user_id, cost in zip(costs['user_id'].tolist(), costs['cost'].tolist()):
+		total, i = heapq.heappop(heap)
+		chunks[i].append(user_id)
+		heapq.heappush(heap, (total+cost, i))
+	totals = numpy.zeros(n, dtype='int64')
+	for total, i in heap:
+		totals[i] = total
+	return chunks, totals
+
+def user_costs(new=None):
+	'''
+	Reads the per-user costs saved by generate_new_df(), or computes them from new (instacart_merged_new)
+	if they were not saved.
+	'''
+	if new is None and artifact_exists('user_costs'):
+		return load_frame('user_costs')
+	if new is None:
+		new = load_frame('instacart_merged_new', columns=['user_id', 'product_id', 'order_number_max'])
+	costs = new.groupby('user_id').agg(num_orders=('order_number_max', 'max'), num_products=('product_id', 'nunique')).reset_index()
+	costs['cost'] = costs['num_orders'].astype('int64')*costs['num_products']
+	return costs
+
+def chunk_costs(chunks, costs=None):
+	'''
+	Returns the expected cost of every chunk, the sum of its users' costs.
+	'''
+	costs = user_costs() if costs is None else costs
+	cost = pd.Series(costs['cost'].values, index=costs['user_id'].values)
+	return numpy.array([cost.reindex(chunk).fillna(0).sum() for chunk in chunks], dtype='int64')
+
+def imbalance(values):
+	'''
+	The largest of values relative to their mean: 1.0 is perfectly balanced.
+	'''
+	values = numpy.asarray(values, dtype='float64')
+	return round(float(values.max()/values.mean()), 3) if len(values) and values.mean()>0 else 1.0
+
+def partition_name(i):
+	return 'Merged_partitions/part_{}'.format(i)
+
+def chunk_name(i):
+	return 'Chunk_partitions/chunk_{}'.format(i)
+
+@instrumented
+def make_chunks(n_chunks=50, target_cost=None, engine='pandas', memory_budget=None):
 	'''
-	Saves a pickle file, a list with 50 sublists, containing an approximately equal number of user_ids
-	from instacart_merged_new (generated by generate_new_df()).
+	Saves a pickle file, a list of n_chunks sublists of user_ids from instacart_merged_new
+	(generated by generate_new_df()), balanced so every chunk has about the same total cost (see user_costs).
+	With target_cost, the number of chunks is instead chosen so each chunk costs about target_cost.
+	Users keep the chunk an earlier run (with as many chunks) put them in, and only new users are balanced
+	(see balanced_chunks()), so the other chunks are not computed again; cleanup() drops the old chunks to rebalance all users.
+	Also splits instacart_merged_new into one file per chunk in Merged_partitions, so later stages
+	only parse the rows of the users they work on. engine='sql' reads each chunk's rows from the embedded database
+	instead (see sql_partitions()), with its memory bounded by memory_budget, so instacart_merged_new is never loaded.
 	'''
-	#check if file already exists
-	filename = 'chunks'
-	if os.path.isfile(filename):
+	#check if the files are up to date with instacart_merged_new
+	key = stage_key('make_chunks', cache_key('instacart_merged_new'), n_chunks, target_cost)
+	if cache_hit('chunks', key):
 		return
 		
 	print("Now making chunks.", datetime.now().strftime("%X, %x"), "\n")
 
-	new = pd.read_csv('instacart_merged_new.csv', index_col=0)
+	new = None if engine=='sql' else load_frame('instacart_merged_new')
+
+	costs = user_costs() if new is None or artifact_exists('user_costs') else user_costs(new)
+	if target_cost is not None:
+		n_chunks = int(numpy.ceil(costs['cost'].sum()/float(target_cost)))
+	#every chunk needs at least one user
+	n_chunks = max(1, min(n_chunks, len(costs)))
+	previous = None
+	if os.path.isfile('chunks'):
+		with open('chunks', 'rb') as fp:
+			previous = pickle.load(fp)
+		if len(previous)!=n_chunks:
+			previous = None
+	chunks, totals = balanced_chunks(costs, n_chunks, previous)
+	round_robin = chunk_costs(chunkify(sorted(costs['user_id']), n_chunks), costs)
+	print("{} chunks, expected imbalance (largest chunk cost / mean) {}, {} for equal user counts\n".format(
+		n_chunks, imbalance(totals), imbalance(round_robin)))
+	current_stage().update(n_chunks=n_chunks, expected_imbalance=imbalance(totals))
+	cache_store('chunks', key, save_partitions(new, chunks, memory_budget))
 
-	chunks = chunkify(list(new['user_id'].unique()), 50)
+def save_partitions(new, chunks, memory_budget=None):
+	'''
+	Saves the chunks pickle, and splits new (instacart_merged_new) into one file per chunk in Merged_partitions,
+	newest orders first within each. A chunk without users gets an empty partition.
+	With new None, the rows of each chunk are read from the embedded database (see sql_partitions()).
+	Returns the files written, for the cache manifest.
+	'''
 	with open('chunks', 'wb') as fp:
 		pickle.dump(chunks, fp)
+
+	if not os.path.exists('Merged_partitions'):
+		os.makedirs('Merged_partitions')
+
+	if new is None:
+		parts = sql_partitions(chunks, memory_budget)
+	else:
+		#sort to get newest orders first within each partition, taking the rows of one chunk at a time
+		chunk_of = {user_id:i for i in range(len(chunks)) for user_id in chunks[i]}
+		rows = new.groupby(new['user_id'].map(chunk_of)).indices
+		parts = (new.iloc[rows.get(i, [])].sort_values(['target', 'order_number'], ascending=[False, False], kind='mergesort')
+				for i in range(len(chunks)))
+	for i, part in enumerate(parts):
+		save_frame(part.reset_index(drop=True), partition_name(i))
+
+	#a partition whose contents did not change keeps its digest, so its chunk is not computed again
+	partitions = [artifact_path(partition_name(i)) for i in range(len(chunks))]
+	for path in partitions:
+		file_digest(path)
+	return ['chunks']+partitions
+
+def chunk_key(i):
+	'''
+	The cache key of chunk i's features: the digest of its partition and the code of the feature engines.
+	'''
+	return stage_key('compute_chunk', file_digest(artifact_path(partition_name(i))))
 		
 
-def do_computations():
+def compute_chunk(i, engine='vectorized', profile=None):
+	'''
+	Computes the user-product features for the users of chunk i, reading only that chunk's partition,
+	and saves them to Chunk_partitions/chunk_{i}.
+	The chunk is measured as a compute_chunk stage (see instrument()), whose record is returned.
+	profile ('cprofile' or 'tracemalloc', see profiled()) profiles the feature engine on this chunk.
+	'''
+	with instrument('compute_chunk', chunk=i, engine=engine) as record:
+		new = load_frame(partition_name(i))
+		record['users'] = int(new['user_id'].nunique())
+
+		#apply the function
+		with profiled(profile, 'chunk_{}'.format(i), record):
+			#a hash shard can hold no users
+			if new.empty:
+				joined = pd.DataFrame({col:pd.Series(dtype='float64') for col in CHUNK_COLUMNS})
+			elif engine=='vectorized':
+				joined = vectorized_computations(new)
+			else:
+				joined = new.groupby('user_id').apply(user_computations)
+				joined = joined.reset_index().drop('level_1', axis=1)
+
+		#save
+		save_frame(joined, chunk_name(i))
+	return record
+
+@instrumented
+def do_computations(engine='vectorized', workers=1, profile=None):
 	'''
-	Loops through the 50 user_id chunks (from make_chunks()), applying the user_computations function and
-	saving a csv.
+	Loops through the user_id chunks (from make_chunks()), computing the user-product features and
+	saving a file per chunk. Chunks already computed from the same partition contents, with the same code, are skipped.
+	engine='vectorized' computes each chunk with vectorized_computations, engine='python' applies
+	user_computations to one user at a time.
+	With workers > 1 the chunks are spread across a pool of worker processes, each of which reads
+	only its own chunk's partition. The costliest chunks are queued first, so an idle worker always
+	takes the largest remaining one.
+	The expected imbalance of the chunks (from their costs) and the actual one (from their times) are reported.
+	profile='cprofile' or 'tracemalloc' profiles the engine on every chunk (see profiled()).
 	'''
 	if not os.path.exists('Chunk_partitions'):
 		os.makedirs('Chunk_partitions')
@@ -256,115 +1306,197 @@ def do_computations():
 	
 	print("Checking for user-product computations at", datetime.now().strftime("%X, %x"), "\n")
 
-	for i in range(len(chunks)):
-		filename = 'Chunk_partitions/chunk_{}.csv'.format(i)
-		if os.path.isfile(filename):
-			continue
-		
-		#read in data
-		new = pd.read_csv('instacart_merged_new.csv', index_col=0)
-		#filter by user_id
-		new = new[new['user_id'].isin(chunks[i])]
+	keys = [chunk_key(i) for i in range(len(chunks))]
+	pending = [i for i in range(len(chunks)) if not cache_hit(chunk_name(i), keys[i])]
+	costs = chunk_costs(chunks)
+	pending.sort(key=lambda i:-costs[i])
 
-		#apply the function
-		joined = new.groupby('user_id').apply(user_computations)
-		joined = joined.reset_index().drop('level_1', axis=1)
+	seconds = {}
+	if workers<=1:
+		for i in pending:
+			seconds[i] = compute_chunk(i, engine, profile)['wall_seconds']
+			cache_store(chunk_name(i), keys[i], [artifact_path(chunk_name(i))])
 
-		#write to csv
-		joined.to_csv(filename)
+			#print status and repeat
+			print("- completed chunk", i, "out of", len(chunks)-1, "at", datetime.now().strftime("%X, %x"))
+	else:
+		#spawned workers import the module afresh, so they are given the format in use
+		with ProcessPoolExecutor(max_workers=workers, initializer=set_storage_format, initargs=(STORAGE_FORMAT,)) as pool:
+			futures = [pool.submit(compute_chunk, i, engine, profile) for i in pending]
+			for future in as_completed(futures):
+				record = future.result()
+				seconds[record['chunk']] = record['wall_seconds']
+				cache_store(chunk_name(record['chunk']), keys[record['chunk']], [artifact_path(chunk_name(record['chunk']))])
+				#the workers write their own records, their I/O still counts toward this stage
+				count_io(**{field:record[field] for field in IO_FIELDS})
+				print("- completed chunk", record['chunk'], "out of", len(chunks)-1, "at", datetime.now().strftime("%X, %x"))
 
-		#print status and repeat
-		print("- completed chunk", i, "out of 49 at", datetime.now().strftime("%X, %x"))
+	if seconds:
+		expected, actual = imbalance(costs[pending]), imbalance(list(seconds.values()))
+		print("\nChunk imbalance (largest / mean): expected {} from costs, actual {} from times".format(expected, actual))
+		current_stage().update(expected_imbalance=expected, actual_imbalance=actual)
 	print()
 
+@instrumented
 def merge_chunks():
 	'''
-	Merge the files formed by do_computations() into a single file.
+	Merges the files formed by do_computations() into joined_current, streaming them into the file one chunk at a time.
+	Every chunk listed in the chunks pickle must have a file with the CHUNK_COLUMNS columns,
+	otherwise nothing is written and an error names the chunks that are missing or malformed.
 	'''
-	filename = 'joined_current.csv'
-	if os.path.isfile(filename):
+	filename = 'joined_current'
+	with open('chunks', 'rb') as fp:
+		chunks = pickle.load(fp)
+	key = stage_key('merge_chunks', [cache_key(chunk_name(i)) for i in range(len(chunks))])
+	if cache_hit(filename, key):
 		return
+
+	missing = [i for i in range(len(chunks)) if not artifact_exists(chunk_name(i))]
+	if missing:
+		raise IOError('No file for chunks {} of {}, run do_computations() first'.format(missing, len(chunks)))
+	malformed = [i for i in range(len(chunks)) if sorted(artifact_columns(chunk_name(i)))!=sorted(CHUNK_COLUMNS)]
+	if malformed:
+		raise ValueError('Files of chunks {} do not have the columns {}, remove them and rerun do_computations()'.format(malformed, CHUNK_COLUMNS))
+
 	print("Now merging the files into", filename, "at", datetime.now().strftime("%X, %x"), "\n")
-	
-	for i in range (0, 50):
-		try:
-			current = current.append(pd.read_csv('Chunk_partitions/chunk_{}.csv'.format(i), index_col=0), ignore_index=True)
-		except:
-			current = pd.read_csv('Chunk_partitions/chunk_{}.csv'.format(i), index_col=0)
-	
-	current.to_csv(filename)
+	save_frames((load_frame(chunk_name(i), columns=CHUNK_COLUMNS)[CHUNK_COLUMNS] for i in range(len(chunks))), filename)
+	cache_store(filename, key, [artifact_path(filename)])
+
+# the shard plan written by make_shards(), read by the shard jobs
+SHARD_PLAN = 'shards.json'
+# Knuth's multiplicative hash constant (2**32 divided by the golden ratio)
+SHARD_HASH = 2654435761
+
+def shard_of(user_ids, n_shards):
+	'''
+	Returns the shard (0 to n_shards-1) of every user_id: the top bits of a multiplicative hash of the id,
+	scaled to n_shards, so consecutive ids spread over all shards and a user's shard never depends on the data.
+	'''
+	hashed = (numpy.asarray(user_ids).astype('uint64')*numpy.uint64(SHARD_HASH)) & numpy.uint64(2**32-1)
+	return ((hashed*numpy.uint64(n_shards)) >> numpy.uint64(32)).astype('int64')
+
+def shard_marker(k):
+	return chunk_name(k) + '.done'
+
+@instrumented
+def make_shards(n_shards, engine='pandas', memory_budget=None):
+	'''
+	The sharded version of make_chunks(): splits the users of instacart_merged_new into n_shards by a hash of their user_id
+	(see shard_of()), writing one partition per shard to Merged_partitions and the shard plan, SHARD_PLAN,
+	which holds the key every shard's output must be computed from (see chunk_key()).
+	Every shard can then be computed by an independent job, with compute_shard(), on any host sharing this folder.
+	engine='sql' reads each shard's rows from the embedded database, as make_chunks() does.
+	'''
+	key = stage_key('make_shards', cache_key('instacart_merged_new'), n_shards)
+	if cache_hit('chunks', key):
+		return
+	print("Now making", n_shards, "shards.", datetime.now().strftime("%X, %x"), "\n")
+
+	new = None if engine=='sql' else load_frame('instacart_merged_new')
+	user_ids = numpy.unique(user_costs()['user_id'].values)
+	shards = shard_of(user_ids, n_shards)
+	chunks = [user_ids[shards==k].tolist() for k in range(n_shards)]
+	totals = chunk_costs(chunks)
+	print("{} shards, expected imbalance (largest shard cost / mean) {}\n".format(n_shards, imbalance(totals)))
+	current_stage().update(n_chunks=n_shards, expected_imbalance=imbalance(totals))
+	files = save_partitions(new, chunks, memory_budget)
+
+	if not os.path.exists('Chunk_partitions'):
+		os.makedirs('Chunk_partitions')
+	with open(SHARD_PLAN + '.tmp', 'w') as fp:
+		json.dump({'n_shards':n_shards, 'keys':[chunk_key(k) for k in range(n_shards)]}, fp, indent=1)
+	os.replace(SHARD_PLAN + '.tmp', SHARD_PLAN)
+	cache_store('chunks', key, files+[SHARD_PLAN])
+
+def load_shard_plan():
+	if not os.path.isfile(SHARD_PLAN):
+		raise IOError('{} not found, run make_shards() first'.format(SHARD_PLAN))
+	with open(SHARD_PLAN) as fp:
+		return json.load(fp)
+
+def shard_done(k, key):
+	'''
+	True when shard k's output exists and its marker says it was computed with key.
+	'''
+	if not (os.path.isfile(shard_marker(k)) and artifact_exists(chunk_name(k))):
+		return False
+	with open(shard_marker(k)) as fp:
+		return json.load(fp)['key']==key
+
+def compute_shard(k, engine='vectorized', profile=None, force=False):
+	'''
+	The compute stage of shard k, run as an independent job: computes the features of the shard's partition
+	(see compute_chunk()), then writes a marker with the key from the shard plan. Shards are skipped when their
+	marker has the current key, unless force is set.
+	Shard jobs only read the shard plan and their own partition, and only write their own chunk and marker, never
+	the cache manifest, so any number of them can run at once against the same folder.
+	'''
+	plan = load_shard_plan()
+	if not 0<=k<plan['n_shards']:
+		raise ValueError('Shard {} out of range, the plan has {} shards'.format(k, plan['n_shards']))
+	key = plan['keys'][k]
+	if not force and shard_done(k, key):
+		print("- shard", k, "is up to date\n")
+		return
+
+	print("Now computing shard", k, "of", plan['n_shards'], "at", datetime.now().strftime("%X, %x"), "\n")
+	if os.path.isfile(shard_marker(k)):
+		os.remove(shard_marker(k))
+	record = compute_chunk(k, engine, profile)
+	with open(shard_marker(k) + '.tmp', 'w') as fp:
+		json.dump({'key':key, 'record':record}, fp, default=str)
+	os.replace(shard_marker(k) + '.tmp', shard_marker(k))
+	print("- completed shard", k, "at", datetime.now().strftime("%X, %x"), "\n")
+
+def simulate_shards(engine='vectorized', profile=None, force=False):
+	'''
+	Runs every shard of the plan as its own process on this machine, all sharing this folder,
+	as separate hosts would (see compute_shard()), and waits for them.
+	'''
+	plan = load_shard_plan()
+	command = [sys.executable, os.path.abspath(__file__), 'compute', '--features', engine, '--format', STORAGE_FORMAT]
+	if profile:
+		command += ['--profile', profile]
+	if force:
+		command.append('--force')
+	print("Starting", plan['n_shards'], "shard processes at", datetime.now().strftime("%X, %x"), "\n")
+	jobs = [subprocess.Popen(command+['--shard', str(k)], stdout=subprocess.DEVNULL) for k in range(plan['n_shards'])]
+	failed = [k for k, job in enumerate(jobs) if job.wait()!=0]
+	if failed:
+		raise RuntimeError('Shards {} failed, see their errors above'.format(failed))
+
+@instrumented
+def gather_shards():
+	'''
+	The coordinator step of a sharded run: checks that every shard of the plan has finished with the key of its
+	current partition, records their outputs in the cache manifest, and merges them into joined_current (see merge_chunks()).
+	'''
+	plan = load_shard_plan()
+	pending = [k for k in range(plan['n_shards']) if not shard_done(k, plan['keys'][k])]
+	if pending:
+		raise IOError('Shards {} of {} have not finished, run compute_shard() for them first'.format(pending, plan['n_shards']))
+
+	seconds = []
+	for k in range(plan['n_shards']):
+		with open(shard_marker(k)) as fp:
+			record = json.load(fp)['record']
+		seconds.append(record['wall_seconds'])
+		if cache_key(chunk_name(k))!=plan['keys'][k]:
+			cache_store(chunk_name(k), plan['keys'][k], [artifact_path(chunk_name(k)), shard_marker(k)])
+	print("Shard imbalance (largest / mean):", imbalance(seconds), "from times\n")
+	current_stage().update(n_shards=plan['n_shards'], actual_imbalance=imbalance(seconds))
+	merge_chunks()
 		
 def is_organic(text):
     if 'organic' in text.lower():
         return 1
     return 0
 
-def last_merges():
+def finalize_features(final):
 	'''
-	Joins instacart_merged_new.csv with the user computations done previously, and saves
-	x_train and x_test.
+	Takes the per user-product frame assembled by last_merges() (or state_features()), adds the
+	support and due ratios, rounds, and returns the columns saved in x_train and x_test.
 	'''
-	filename = ['x_test.csv', 'x_train.csv']
-	if os.path.isfile(filename[0]) or os.path.isfile(filename[1]):
-		return
-	print("Now computing", filename[0], "and", filename[1], "at", datetime.now().strftime("%X, %x"), "\n")
-	
-	new = pd.read_csv('instacart_merged_new.csv', index_col=0)
-	
-	new.sort_values(['target', 'order_number'], ascending=[False, False], inplace=True)
-
-	# create class, based on the hour of day
-	new['time_period'] = 'afternoon'
-	new.loc[new['order_hour_of_day']<=12, 'time_period'] = 'morning'
-	new.loc[new['order_hour_of_day']<=4, 'time_period'] = 'late'
-	new.loc[new['order_hour_of_day'] >=19, 'time_period'] = 'late'
-	
-	#Drop duplicate user_id, product_id pairs to get the necessary number of X sets (rows)
-	final = new.groupby(['user_id', 'product_id']).first().reset_index()
-	
-	# drop all entries in 'new' from the train set (no peeking at the future!)
-	new = new[new['eval_set']=='prior']
-	
-	#get user-based values, reordered average and most recent order size
-	user_only = pd.DataFrame(new.groupby('user_id')['reordered'].mean())
-	user_only['prev_ord_size'] = new[['user_id', 'order_number', 'ord_size']].drop_duplicates().sort_values('order_number', ascending=False).groupby('user_id').first()['ord_size']
-	user_only.columns = ['reordered_usr_avg', 'prev_ord_size']
-	user_only.reset_index(inplace=True)
-	
-	final = final.merge(user_only, on='user_id', how='left')
-	del user_only
-	
-	# get ratio for average order position
-	user_product = new.groupby(['user_id', 'product_id'])[['add_to_cart_order', 'ord_size']].sum().reset_index()
-	user_product= user_product.astype(float)
-	user_product['avg_ord_pos'] = user_product['add_to_cart_order']/user_product['ord_size']
-	user_product['avg_ord_pos'] = user_product['avg_ord_pos'].round(2)
-	
-	#merge final with user_product
-	final = final.merge(user_product[['user_id', 'product_id', 'avg_ord_pos']], on=['user_id', 'product_id'], how='left')
-	del user_product
-	
-	# self-merge for average days between order, average order size
-	final = final.merge(new.drop_duplicates('order_id').groupby('user_id')['days_since_prior_order'].mean().reset_index().rename(columns={'days_since_prior_order':'avg_days_between_orders'}), how='left', on='user_id')
-	final = final.merge(new.drop_duplicates('order_id').groupby('user_id')['ord_size'].mean().reset_index().rename(columns={'ord_size':'avg_order_size'}), how='left', on='user_id')
-	del new
-	
-	#merge with computations
-	current = pd.read_csv('joined_current.csv', index_col=0)
-	final = final.merge(current, on=['user_id', 'product_id', 'order_number'], how='left')
-	del current
-	
-	final.rename(columns={'avg_prod_disp':'usr_avg_prod_disp', 'avg_aisle_disp':'usr_avg_aisle_disp',
-                  'avg_dept_disp':'usr_avg_dept_disp'}, inplace=True)
-	
-	# overall averages - grouped by product, aisle, and department
-	final = final.merge(final.drop_duplicates(['user_id', 'product_id']).groupby('product_id')['usr_avg_prod_disp'].mean().reset_index().rename(columns={'usr_avg_prod_disp':'overall_avg_prod_disp'}), on='product_id', how='left')
-	final = final.merge(final.drop_duplicates(['user_id', 'aisle_id']).groupby('aisle_id')['usr_avg_aisle_disp'].mean().reset_index().rename(columns={'usr_avg_aisle_disp':'overall_avg_aisle_disp'}), on='aisle_id', how='left')
-	final = final.merge(final.drop_duplicates(['user_id', 'department_id']).groupby('department_id')['usr_avg_dept_disp'].mean().reset_index().rename(columns={'usr_avg_dept_disp':'overall_avg_dept_disp'}), on='department_id', how='left')
-	
-	del final['target_y']
-	final.rename(columns={'order_number_max':'num_orders_placed','target_x':'target'}, inplace=True)
-	
 	#take a few ratios	
 	final['perc_prod_support'] = final['prod_support']/final['num_orders_placed']
 	final['perc_aisle_support'] = final['aisle_support']/final['num_orders_placed']
@@ -400,10 +1532,11 @@ def last_merges():
 	
 	final['prod_aisle_ratio'] = final['prod_aisle_ratio'].round(3)
 	final['prod_dept_ratio'] = final['prod_dept_ratio'].round(3)
-	
+
+	final['prod_reorder_rate'] = final['prod_reorder_rate'].round(3)
 	final['tod_lift'] = final['tod_lift'].round(3)
 	final['dow_lift'] = final['dow_lift'].round(3)
-
+	
 	#select relevant columns
 
 	final = final[['user_id', 'order_id', 'product_id', 'target',
@@ -435,13 +1568,604 @@ def last_merges():
 	'aisle_due_overall_perc',
 	'aisle_due_user_perc',
 	'dept_due_overall_perc',
-	'dept_due_user_perc'
+	'dept_due_user_perc',
+	'prod_reorder_rate',
+	'tod_lift',
+	'dow_lift'
 				  ]]
+	return final
 	
-	final[final['target']==2].to_csv('x_test.csv')
-	final[final['target']!=2].to_csv('x_train.csv')
+# columns of the rows kept per user_id, product_id pair in last_merges()
+FINAL_COLUMNS = ['user_id', 'product_id', 'order_id', 'order_number', 'order_dow', 'order_hour_of_day', 'order_number_max', 'aisle_id', 'department_id', 'target']
+
+def target_orders():
+	'''
+	Reads each user's current train/test order from orders.csv, the order the lifts of product_features() are computed for,
+	as target_hour and target_dow indexed by user_id. The merged rows lack the train orders without any reordered product.
+	'''
+	orders = read_input('orders.csv', usecols=['user_id', 'eval_set', 'order_hour_of_day', 'order_dow'],
+						dtype={'user_id':'int32', 'eval_set':SCHEMA['eval_set'], 'order_hour_of_day':'uint8', 'order_dow':'uint8'})
+	orders = orders[orders['eval_set']!='prior'].set_index('user_id')
+	return orders[['order_hour_of_day', 'order_dow']].rename(columns={'order_hour_of_day':'target_hour', 'order_dow':'target_dow'})
+
+def final_rows():
+	'''
+	The relational part of last_merges(): keeps each user_id, product_id pair's most recent row of instacart_merged_new,
+	and joins it with the user-based values and the average order position, computed from the prior orders, and the
+	hour and day of the user's current order (see target_orders()).
+	'''
+	new = load_frame('instacart_merged_new')
+	
+	#keep each user_id, product_id pair's most recent row to get the necessary number of X sets (rows)
+	new.sort_values(['target', 'order_number'], ascending=[False, False], inplace=True, kind='mergesort')
+	final = new.loc[~new.duplicated(['user_id', 'product_id']), FINAL_COLUMNS]
+	final = final.sort_values(['user_id', 'product_id']).reset_index(drop=True)
+
+	# drop all entries in 'new' from the train set (no peeking at the future!)
+	new = new.loc[new['eval_set']=='prior', ['user_id', 'product_id', 'order_id', 'order_number', 'add_to_cart_order', 'reordered',
+											'days_since_prior_order', 'ord_size']]
+
+	# one row per prior order, for the user-based values, averaged in float64 so they round as the saved features always have
+	orders = new.drop_duplicates('order_id').sort_values(['user_id', 'order_number'])
+	orders = orders.astype({'days_since_prior_order':'float64', 'ord_size':'float64'})
+	by_user = orders.groupby('user_id')
+	reordered = new.groupby('user_id')['reordered'].agg(['sum', 'count']).astype('float64')
+	users = pd.DataFrame({'reordered_usr_avg':reordered['sum']/reordered['count'],
+						'prev_ord_size':by_user['ord_size'].last(),
+						'avg_days_between_orders':by_user['days_since_prior_order'].mean(),
+						'avg_order_size':by_user['ord_size'].mean()})
+	del orders, by_user, reordered
+	final = final.join(users, on='user_id')
+	del users
+	
+	# get ratio for average order position
+	sums = new.groupby(['user_id', 'product_id'])[['add_to_cart_order', 'ord_size']].sum().astype(float)
+	final = final.join((sums['add_to_cart_order']/sums['ord_size']).round(2).rename('avg_ord_pos'), on=['user_id', 'product_id'])
+	return final.join(target_orders(), on='user_id')
+
+def sql_final_rows(memory_budget=None):
+	'''
+	The engine='sql' version of final_rows(), run against the merged table of SQL_DATABASE (see sql_generate_new_df()).
+	The aggregates are summed in the database, and divided and rounded here as final_rows() does.
+	'''
+	if not os.path.isfile(SQL_DATABASE):
+		raise IOError('{} not found, run generate_new_df(engine=\'sql\') first'.format(SQL_DATABASE))
+	connection = sql_connect(memory_budget)
+
+	#keep each user_id, product_id pair's most recent row
+	final = pd.concat(sql_frames(connection, '''SELECT {0} FROM (
+		SELECT *, CASE eval_set WHEN 'prior' THEN 0 WHEN 'train' THEN 1 ELSE 2 END AS target,
+			ROW_NUMBER() OVER (PARTITION BY user_id, product_id ORDER BY eval_set!='prior' DESC, order_number DESC) AS recency
+		FROM merged) WHERE recency=1 ORDER BY user_id, product_id'''.format(', '.join(FINAL_COLUMNS))), ignore_index=True)
+	final = apply_schema(final)
+
+	# user-based values, from the prior orders
+	users = pd.read_sql_query('''SELECT o.user_id, r.reordered_sum, r.reordered_count, o.order_number, o.ord_size AS prev_ord_size,
+		o.days_sum, o.days_count, o.size_sum, o.order_count
+		FROM (SELECT user_id, SUM(reordered) AS reordered_sum, COUNT(reordered) AS reordered_count
+			FROM merged WHERE eval_set='prior' GROUP BY user_id) r
+		JOIN (SELECT user_id, MAX(order_number) AS order_number, ord_size, SUM(days) AS days_sum, COUNT(days) AS days_count,
+				SUM(ord_size) AS size_sum, COUNT(ord_size) AS order_count
+			FROM (SELECT user_id, order_id, MAX(order_number) AS order_number, MAX(days_since_prior_order) AS days, MAX(ord_size) AS ord_size
+				FROM merged WHERE eval_set='prior' GROUP BY order_id)
+			GROUP BY user_id) o ON o.user_id=r.user_id''', connection, index_col='user_id')
+	users = users.astype('float64')
+	final = final.join(pd.DataFrame({'reordered_usr_avg':users['reordered_sum']/users['reordered_count'],
+									'prev_ord_size':users['prev_ord_size'],
+									'avg_days_between_orders':users['days_sum']/users['days_count'],
+									'avg_order_size':users['size_sum']/users['order_count']}), on='user_id')
+	del users
+
+	# get ratio for average order position
+	sums = pd.concat(sql_frames(connection, '''SELECT user_id, product_id, SUM(add_to_cart_order) AS add_to_cart_order, SUM(ord_size) AS ord_size
+		FROM merged WHERE eval_set='prior' GROUP BY user_id, product_id'''), ignore_index=True)
+	sums = apply_schema(sums).set_index(['user_id', 'product_id']).astype(float)
+	final = final.join((sums['add_to_cart_order']/sums['ord_size']).round(2).rename('avg_ord_pos'), on=['user_id', 'product_id'])
+
+	# the user's current train/test order
+	targets = pd.read_sql_query('''SELECT user_id, order_hour_of_day AS target_hour, order_dow AS target_dow
+		FROM orders WHERE eval_set!='prior' ''', connection, index_col='user_id')
+	final = final.join(targets.astype('uint8'), on='user_id')
+	connection.close()
+	return final
+
+@instrumented
+def last_merges(output_format=None, engine='pandas', memory_budget=None):
+	'''
+	Joins instacart_merged_new with the user computations done previously, and saves
+	x_train and x_test, in STORAGE_FORMAT unless another output_format (e.g. 'csv') is given.
+	engine='sql' runs the joins and aggregations over instacart_merged_new in the embedded database
+	(see sql_final_rows()), with its memory bounded by memory_budget.
+	'''
+	filename = [artifact_path('x_test', output_format), artifact_path('x_train', output_format)]
+	key = stage_key('last_merges', cache_key('instacart_merged_new'), cache_key('joined_current'), output_format)
+	if cache_hit('x_train', key):
+		return
+	print("Now computing", filename[0], "and", filename[1], "at", datetime.now().strftime("%X, %x"), "\n")
+
+	final = sql_final_rows(memory_budget) if engine=='sql' else final_rows()
+
+	# product reorder rate, and lifts of the time of day (see HOUR_PERIOD) and day of week of the row's order
+	final = product_features(final, load_product_index())
+	
+	#join with computations
+	current = load_frame('joined_current').set_index(['user_id', 'product_id', 'order_number']).drop(columns='target')
+	final = final.join(current, on=['user_id', 'product_id', 'order_number'])
+	del current
+	
+	final.rename(columns={'avg_prod_disp':'usr_avg_prod_disp', 'avg_aisle_disp':'usr_avg_aisle_disp',
+                  'avg_dept_disp':'usr_avg_dept_disp', 'order_number_max':'num_orders_placed'}, inplace=True)
+	
+	# overall averages - grouped by product, aisle, and department, counting each user once
+	final['overall_avg_prod_disp'] = final.groupby('product_id')['usr_avg_prod_disp'].transform('mean')
+	for level, col in [('aisle_id', 'aisle'), ('department_id', 'dept')]:
+		first = ~final.duplicated(['user_id', level])
+		overall = final.loc[first, 'usr_avg_{}_disp'.format(col)].groupby(final.loc[first, level]).mean()
+		final['overall_avg_{}_disp'.format(col)] = final[level].map(overall)
+
+	final = finalize_features(final)
+
+	save_frame(final[final['target']==2], 'x_test', output_format)
+	save_frame(final[final['target']!=2], 'x_train', output_format)
+	cache_store('x_train', key, filename, evictable=False)
 	print(final['target'].value_counts())
 	
+STATE_TABLES = ['users', 'products', 'aisles', 'departments']
+# rows per parquet row group in the feature state tables
+STATE_ROW_GROUP = 20000
+
+def state_name(table):
+	return 'Feature_state/{}'.format(table)
+
+def empty_table(columns, key):
+	return pd.DataFrame({col:pd.Series(dtype='int64' if col in ('user_id', key) else 'float64') for col in columns})
+
+def fold_keys(old, events, key):
+	'''
+	Folds prior events (user_id, key, order_number, cum, ...) of orders newer than old into the
+	running (user, key) aggregates in old (None to start from scratch):
+	support, cumulative days at the first and last order with the key, the last order number and the length
+	of the run of consecutive orders ending there. For products, also the last order_id and its order_hour_of_day
+	and order_dow, add_to_cart_order and ord_size sums, aisle_id and department_id.
+	'''
+	products = key=='product_id'
+	if not products:
+		events = events.drop_duplicates(['user_id', key, 'order_number'])
+	events = events.sort_values(['user_id', key, 'order_number'])
+
+	users = events['user_id'].values
+	keys = events[key].values
+	order_number = events['order_number'].values.astype('int64')
+	cum = events['cum'].values
+
+	# one segment per (user, key), oldest order first
+	first = numpy.ones(len(events), dtype=bool)
+	first[1:] = (users[1:]!=users[:-1]) | (keys[1:]!=keys[:-1])
+	starts = numpy.flatnonzero(first)
+	count = numpy.diff(numpy.append(starts, len(events)))
+	last = starts+count-1
+
+	# start of the run of consecutive order numbers that ends each segment
+	breaks = first.copy()
+	breaks[1:] |= order_number[1:]!=order_number[:-1]+1
+	run_start = numpy.maximum.reduceat(numpy.where(breaks, numpy.arange(len(events)), 0), starts) if len(starts) else starts
+
+	update = pd.DataFrame({'user_id':users[starts], key:keys[starts], 'count':count.astype(float),
+						'first_cum_new':cum[starts], 'last_cum_new':cum[last],
+						'first_order':order_number[starts], 'last_order_new':order_number[last],
+						'run_new':(last-run_start+1).astype(float), 'whole_run':run_start==starts})
+	if products:
+		update['last_order_id_new'] = events['order_id'].values[last]
+		update['last_hour_new'] = events['order_hour_of_day'].values[last]
+		update['last_dow_new'] = events['order_dow'].values[last]
+		update['aisle_id'] = events['aisle_id'].values[starts]
+		update['department_id'] = events['department_id'].values[starts]
+		for col in ['add_to_cart_order', 'ord_size']:
+			update[col] = numpy.add.reduceat(events[col].values.astype(float), starts) if len(starts) else 0.
+
+	columns = ['user_id', key, 'support', 'first_cum', 'last_cum']
+	if products:
+		columns = ['user_id', key, 'aisle_id', 'department_id', 'support', 'first_cum', 'last_cum',
+				'last_order', 'last_order_id', 'last_hour', 'last_dow', 'run', 'cart_sum', 'size_sum', 'in_target']
+		if old is None:
+			old = empty_table(columns, key)
+		merged = old.merge(update, on=['user_id', key], how='outer', suffixes=('_old', ''))
+		for col in ['aisle_id', 'department_id']:
+			merged[col] = merged[col].fillna(merged[col+'_old'])
+	else:
+		if old is None:
+			old = empty_table(columns, key)
+		merged = old.merge(update, on=['user_id', key], how='outer')
+
+	seen = merged['support'].notnull()
+	fresh = merged['count'].notnull()
+	merged['support'] = merged['support'].fillna(0)+merged['count'].fillna(0)
+	merged['first_cum'] = merged['first_cum'].where(seen, merged['first_cum_new'])
+	merged['last_cum'] = merged['last_cum_new'].where(fresh, merged['last_cum'])
+
+	if products:
+		# the run carries on from the old state only if every new order continues it
+		continued = seen & merged['whole_run'].fillna(False).astype(bool) & (merged['last_order']==merged['first_order']-1)
+		merged['run'] = numpy.where(fresh, numpy.where(continued, merged['run'].fillna(0)+merged['count'], merged['run_new']), merged['run'])
+		merged['last_order'] = merged['last_order_new'].where(fresh, merged['last_order'])
+		merged['last_order_id'] = merged['last_order_id_new'].where(fresh, merged['last_order_id'])
+		merged['last_hour'] = merged['last_hour_new'].where(fresh, merged['last_hour'])
+		merged['last_dow'] = merged['last_dow_new'].where(fresh, merged['last_dow'])
+		merged['cart_sum'] = merged['cart_sum'].fillna(0)+merged['add_to_cart_order'].fillna(0)
+		merged['size_sum'] = merged['size_sum'].fillna(0)+merged['ord_size'].fillna(0)
+		merged['in_target'] = merged['in_target'].fillna(0)
+
+	return merged[columns].sort_values(['user_id', key]).reset_index(drop=True)
+
+def fold_orders(state, prior):
+	'''
+	Folds prior rows (in the layout of instacart_merged_new) into the feature state, a dict of the
+	users, products, aisles and departments tables, and returns the new state. state may be None to start
+	from scratch; otherwise every order in prior must be newer than the user's last folded order.
+	Every feature computed by user_computations() is a function of these running aggregates and the
+	user's current train/test order (see state_features()).
+	'''
+	# one row per prior order, oldest first within each user
+	orders = prior.groupby(['user_id', 'order_number']).agg(order_id=('order_id', 'first'),
+						days=('days_since_prior_order', 'max'), ord_size=('ord_size', 'max'),
+						items=('product_id', 'size'), reordered=('reordered', 'sum')).reset_index()
+
+	old = state['users'].set_index('user_id') if state else None
+	if old is not None:
+		last_prior = orders['user_id'].map(old['last_prior']).fillna(0).values
+		if (orders['order_number'].values<=last_prior).any():
+			raise ValueError('New orders must be newer than the orders already in the feature state.')
+
+	# cumulative days since each user's first order, continuing from the state
+	days = orders['days'].values.astype(float)
+	base = orders['user_id'].map(old['elapsed']).fillna(0).values if old is not None else 0.
+	orders['cum'] = base+pd.Series(numpy.where(numpy.isnan(days), 0., days)).groupby(orders['user_id'].values).cumsum().values
+
+	group = orders.groupby('user_id')
+	update = pd.DataFrame({'n_prior':group.size(), 'last_prior':group['order_number'].max(),
+						'elapsed':group['cum'].last(), 'days_count':group['days'].count(),
+						'ord_size_sum':group['ord_size'].sum(), 'prev_ord_size':group['ord_size'].last(),
+						'reordered_sum':group['reordered'].sum(), 'item_count':group['items'].sum()})
+	if old is None:
+		users = update
+		for col in ['order_number_max', 'target_order_id', 'target', 'target_days', 'target_hour', 'target_dow']:
+			users[col] = 0
+	else:
+		users = old.reindex(old.index.union(update.index))
+		# whole columns are rebuilt, the compact dtypes of the loaded state cannot hold the summed values
+		for col in ['n_prior', 'days_count', 'ord_size_sum', 'reordered_sum', 'item_count']:
+			users[col] = users[col].add(update[col], fill_value=0)
+		for col in ['last_prior', 'elapsed', 'prev_ord_size']:
+			users[col] = update[col].combine_first(users[col])
+		users = users.fillna({'order_number_max':0, 'target_order_id':0, 'target':0, 'target_days':0, 'target_hour':0, 'target_dow':0})
+
+	events = prior[['user_id', 'product_id', 'aisle_id', 'department_id', 'order_number', 'order_id', 'order_hour_of_day', 'order_dow',
+					'add_to_cart_order', 'ord_size']]
+	events = events.merge(orders[['user_id', 'order_number', 'cum']], on=['user_id', 'order_number'], how='left')
+
+	return {'users':users.reset_index().rename(columns={'index':'user_id'}),
+			'products':fold_keys(state['products'] if state else None, events, 'product_id'),
+			'aisles':fold_keys(state['aisles'] if state else None, events[['user_id', 'aisle_id', 'order_number', 'cum']], 'aisle_id'),
+			'departments':fold_keys(state['departments'] if state else None, events[['user_id', 'department_id', 'order_number', 'cum']], 'department_id')}
+
+def set_targets(state, targets, target_rows):
+	'''
+	Points the users in targets (one row per user: user_id, order_id, order_number, target, days_since_prior_order,
+	order_hour_of_day, order_dow) at their current train/test order. target_rows are that order's rows in the layout of instacart_merged_new:
+	the reordered products of a train order, or one row per product for a test order.
+	'''
+	users = state['users'].set_index('user_id')
+	products = state['products']
+	targets = targets.set_index('user_id')
+
+	# whole columns are rebuilt, the compact dtypes of a loaded state reject values assigned to a subset of rows
+	for col, source in [('order_number_max', 'order_number'), ('target_order_id', 'order_id'), ('target', 'target'),
+						('target_hour', 'order_hour_of_day'), ('target_dow', 'order_dow')]:
+		users[col] = targets[source].combine_first(users[col])
+
+	pairs = pd.MultiIndex.from_frame(target_rows[['user_id', 'product_id']])
+	retarget = products['user_id'].isin(targets.index).values
+	in_target = pd.MultiIndex.from_frame(products[['user_id', 'product_id']]).isin(pairs)
+	products['in_target'] = numpy.where(retarget, in_target, products['in_target']).astype('uint8')
+
+	# the train/test order only counts toward the days since an order if any of its products made it into the data
+	present = products[products['in_target']>0]['user_id'].unique()
+	target_days = pd.Series(numpy.where(targets.index.isin(present), targets['days_since_prior_order'].fillna(0), 0), index=targets.index)
+	users['target_days'] = target_days.combine_first(users['target_days'])
+
+	state['users'] = users.reset_index()
+	state['products'] = products
+	return state
+
+def merged_state(new, current=None):
+	'''
+	Builds the feature state (see fold_orders()) of the users in new, rows in the layout of instacart_merged_new.
+	current (see target_orders()) gives the hour and day of the users' current orders, which new lacks for
+	train orders without any reordered product.
+	'''
+	state = fold_orders(None, new[new['eval_set']=='prior'])
+
+	# train users with no reordered products in their train order have no rows for it, only its order number
+	users = state['users'].set_index('user_id')
+	users['order_number_max'] = new.groupby('user_id')['order_number_max'].max()
+	users['target'] = 1
+	state['users'] = users.reset_index()
+
+	target_rows = new[new['target']>0]
+	targets = target_rows.groupby('user_id')[['order_id', 'order_number', 'target', 'days_since_prior_order',
+											'order_hour_of_day', 'order_dow']].first().reset_index()
+	state = set_targets(state, targets, target_rows)
+	if current is not None:
+		users = state['users'].set_index('user_id')
+		for col in ['target_hour', 'target_dow']:
+			users[col] = current[col].reindex(users.index).fillna(users[col])
+		state['users'] = users.reset_index()
+	return state
+
+def save_feature_state(state, index):
+	'''
+	Saves the feature state, its overall averages and the product index to Feature_state.
+	The tables are sorted by user_id and stored in small row groups, so one user's state can be read
+	without scanning the whole table.
+	'''
+	if not os.path.exists('Feature_state'):
+		os.makedirs('Feature_state')
+	for table in state:
+		save_frame(state[table], state_name(table), row_group_size=STATE_ROW_GROUP)
+	save_product_index(index, state_name(PRODUCT_INDEX))
+
+	averages = overall_averages(state)
+	for name, key in [('overall_avg_prod_disp', 'product_id'), ('overall_avg_aisle_disp', 'aisle_id'), ('overall_avg_dept_disp', 'department_id')]:
+		save_frame(averages[name].rename_axis(key).reset_index(name=name), state_name(name))
+
+@instrumented
+def build_feature_state():
+	'''
+	Builds the feature state (see fold_orders()) from instacart_merged_new and saves it to Feature_state,
+	so new orders can later be added with update_features() instead of rerunning the whole pipeline.
+	Every table is keyed by user, so the state is built from one partition of Merged_partitions (see make_chunks())
+	at a time, and instacart_merged_new is never loaded whole.
+	'''
+	key = stage_key('build_feature_state', cache_key('instacart_merged_new'), cache_key('chunks'))
+	if cache_hit('Feature_state', key):
+		return
+	print("Now building the feature state at", datetime.now().strftime("%X, %x"), "\n")
+
+	if not os.path.isfile('chunks'):
+		raise IOError('chunks not found, run make_chunks() first')
+	with open('chunks', 'rb') as fp:
+		chunks = pickle.load(fp)
+	current = target_orders()
+	parts = [merged_state(load_frame(partition_name(i)), current) for i in range(len(chunks)) if chunks[i]]
+	state = {}
+	for table, sort in [('users', ['user_id']), ('products', ['user_id', 'product_id']), ('aisles', ['user_id', 'aisle_id']),
+						('departments', ['user_id', 'department_id'])]:
+		state[table] = pd.concat([part[table] for part in parts], ignore_index=True).sort_values(sort).reset_index(drop=True)
+		for part in parts:
+			del part[table]
+	del parts
+	save_feature_state(state, load_product_index())
+	files = [artifact_path(state_name(name)) for name in STATE_TABLES+['overall_avg_prod_disp', 'overall_avg_aisle_disp', 'overall_avg_dept_disp']]
+	files.append(state_name(PRODUCT_INDEX)+'.npz')
+	cache_store('Feature_state', key, files, evictable=False)
+
+def load_feature_state(user_ids=None):
+	'''
+	Reads the feature state saved by build_feature_state(), optionally only for the given users.
+	'''
+	return {table:load_frame(state_name(table), user_ids=user_ids) for table in STATE_TABLES}
+
+def load_overall_averages():
+	'''
+	Reads the overall averages saved with the feature state, in the form returned by overall_averages().
+	'''
+	averages = {}
+	for name, key in [('overall_avg_prod_disp', 'product_id'), ('overall_avg_aisle_disp', 'aisle_id'), ('overall_avg_dept_disp', 'department_id')]:
+		df = load_frame(state_name(name))
+		averages[name] = pd.Series(df[name].values.astype('float64'), index=df[key].values)
+	return averages
+
+def overall_averages(state):
+	'''
+	Averages of the users' average product, aisle and department displacements, across all users in state,
+	indexed by product_id, aisle_id and department_id.
+	'''
+	horizon = state['users'].set_index('user_id').eval('target_days+elapsed').astype('float64')
+	averages = {}
+	for table, key, name in [('products', 'product_id', 'overall_avg_prod_disp'), ('aisles', 'aisle_id', 'overall_avg_aisle_disp'),
+							('departments', 'department_id', 'overall_avg_dept_disp')]:
+		df = state[table]
+		disp = ((df['user_id'].map(horizon)-df['first_cum'])/df['support']).round(2)
+		averages[name] = disp.groupby(df[key].values).mean()
+	return averages
+
+def state_features(state, averages, index):
+	'''
+	Computes the x_train/x_test rows of every user in state, from the running aggregates, the
+	overall averages (see overall_averages()) and the product index, matching last_merges().
+	'''
+	users = state['users'].set_index('user_id')
+	users['horizon'] = users['target_days']+users['elapsed']
+	final = state['products'].join(users, on='user_id')
+	final = final.astype({col:'float64' for col in final.columns if final[col].dtype=='float32'})
+
+	# rows in the current train/test order take its order_id, the others the user's last order of the product
+	in_target = final['in_target']>0
+	final['order_id'] = numpy.where(in_target, final['target_order_id'], final['last_order_id'])
+	final['target'] = numpy.where(in_target, final['target'], 0)
+	final['order_hour_of_day'] = numpy.where(in_target, final['target_hour'], final['last_hour'])
+	final['order_dow'] = numpy.where(in_target, final['target_dow'], final['last_dow'])
+	final['num_orders_placed'] = final['order_number_max']
+
+	# days/orders since, and average days between, orders with the product, its aisle and its department
+	final['days_since_prod'] = final['horizon']-final['last_cum']
+	final['usr_avg_prod_disp'] = ((final['horizon']-final['first_cum'])/final['support']).round(2)
+	final['orders_since_prod'] = final['order_number_max']-final['last_order']
+	final['streak_length'] = numpy.where(final['last_order']==final['order_number_max']-1, final['run'], 0)
+	final['order_aisle_displacement'] = final['usr_avg_prod_disp']
+	final['prod_support'] = final['support']
+
+	for table, key, prefix, suffix in [('aisles', 'aisle_id', 'aisle', 'aisle'), ('departments', 'department_id', 'dept', 'department')]:
+		keyed = state[table].set_index(['user_id', key])
+		keyed = final[['user_id', key]].join(keyed, on=['user_id', key])
+		final['days_since_'+suffix] = final['horizon']-keyed['last_cum']
+		final['usr_avg_{}_disp'.format(prefix)] = ((final['horizon']-keyed['first_cum'])/keyed['support']).round(2)
+		final[prefix+'_support'] = keyed['support']
+
+	# user-based values
+	final['reordered_usr_avg'] = final['reordered_sum']/final['item_count']
+	final['avg_days_between_orders'] = final['elapsed']/final['days_count']
+	final['avg_order_size'] = final['ord_size_sum']/final['n_prior']
+	final['avg_ord_pos'] = (final['cart_sum']/final['size_sum']).round(2)
+
+	for name, key in [('overall_avg_prod_disp', 'product_id'), ('overall_avg_aisle_disp', 'aisle_id'), ('overall_avg_dept_disp', 'department_id')]:
+		final[name] = final[key].map(averages[name])
+	final = product_features(final, index)
+
+	return finalize_features(final.sort_values(['user_id', 'product_id']).reset_index(drop=True))
+
+# number of users whose feature state features_for_user() keeps in memory
+USER_CACHE_SIZE = 10000
+user_cache = OrderedDict()
+averages_cache = {}
+index_cache = {}
+state_files = {}
+
+def clear_feature_cache():
+	'''
+	Empties the caches used by features_for_user(), e.g. after update_features() rewrote the feature state.
+	'''
+	user_cache.clear()
+	averages_cache.clear()
+	index_cache.clear()
+	state_files.clear()
+
+def read_state_rows(table, user_ids):
+	'''
+	Reads the rows of user_ids from a feature state table. For parquet, the user_id range of every row group
+	is read once and kept, so a lookup only opens the row groups that can hold those users.
+	'''
+	if STORAGE_FORMAT!='parquet':
+		return load_frame(state_name(table), user_ids=user_ids)
+
+	if table not in state_files:
+		parquet = arrow().parquet.ParquetFile(artifact_path(state_name(table)))
+		column = parquet.schema_arrow.get_field_index('user_id')
+		stats = [parquet.metadata.row_group(i).column(column).statistics for i in range(parquet.num_row_groups)]
+		state_files[table] = (parquet, numpy.array([stat.min for stat in stats]), numpy.array([stat.max for stat in stats]))
+	parquet, lows, highs = state_files[table]
+
+	# the tables are sorted by user_id, so each user's rows sit in a run of consecutive row groups
+	user_ids = numpy.unique(user_ids)
+	first = numpy.searchsorted(highs, user_ids, side='left')
+	last = numpy.searchsorted(lows, user_ids, side='right')
+	groups = sorted(set(group for a, b in zip(first, last) for group in range(a, b)))
+
+	df = parquet.read_row_groups(groups).to_pandas()
+	return apply_schema(df[df['user_id'].isin(user_ids)].reset_index(drop=True))
+
+def cached_feature_state(user_ids):
+	'''
+	Returns the feature state of user_ids from an LRU cache of at most USER_CACHE_SIZE users,
+	reading all the users missing from it in one pass over Feature_state.
+	'''
+	missing = sorted(set(user_id for user_id in user_ids if user_id not in user_cache))
+	states = []
+	if missing:
+		state = {table:read_state_rows(table, missing) for table in STATE_TABLES}
+		unknown = set(missing)-set(state['users']['user_id'])
+		if unknown:
+			raise KeyError('Users not in the feature state: {}'.format(sorted(unknown)[:10]))
+		states.append(state)
+
+		# cache each user's slice of the tables, which are sorted by user_id
+		bounds = {table:numpy.searchsorted(state[table]['user_id'].values, [missing, numpy.add(missing, 1)]) for table in STATE_TABLES}
+		for i, user_id in enumerate(missing):
+			user_cache[user_id] = {table:state[table].iloc[bounds[table][0][i]:bounds[table][1][i]] for table in STATE_TABLES}
+
+	hits = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in missing]
+	for user_id in user_ids:
+		user_cache.move_to_end(user_id)
+	states += [user_cache[user_id] for user_id in hits]
+	while len(user_cache)>USER_CACHE_SIZE:
+		user_cache.popitem(last=False)
+
+	if len(states)==1:
+		return states[0]
+	return {table:pd.concat([state[table] for state in states], ignore_index=True) for table in STATE_TABLES}
+
+def cached_overall_averages():
+	if not averages_cache:
+		averages_cache.update(load_overall_averages())
+	return averages_cache
+
+def cached_product_index():
+	if not index_cache:
+		index_cache.update(load_product_index(state_name(PRODUCT_INDEX)))
+	return index_cache
+
+def features_for_user(user):
+	'''
+	Returns the x_train/x_test rows (the columns saved by last_merges()) of one user, given either
+	a user_id from the saved feature state or the user's order history, as rows in the layout of
+	instacart_merged_new. The overall averages and the product index come from the saved feature state.
+	'''
+	if isinstance(user, pd.DataFrame):
+		state = merged_state(user)
+	else:
+		state = cached_feature_state([user])
+	return state_features(state, cached_overall_averages(), cached_product_index())
+
+def features_for_users(user_ids):
+	'''
+	Batch version of features_for_user() for a list of user_ids.
+	'''
+	return state_features(cached_feature_state(list(user_ids)), cached_overall_averages(), cached_product_index())
+
+@instrumented
+def update_features(orders_file, order_products_file, output_format=None):
+	'''
+	Adds new orders to the feature state and re-emits the x_train/x_test rows of the users they belong to,
+	without rerunning the pipeline. orders_file and order_products_file follow orders.csv and order_products__*.csv;
+	prior orders are folded into the state, and a train or test order becomes the user's current order.
+	The overall averages and the product index are updated from the whole state, but only the affected users' rows are rewritten.
+	'''
+	print("Now updating features from", orders_file, "at", datetime.now().strftime("%X, %x"), "\n")
+	state = load_feature_state()
+	index = load_product_index(state_name(PRODUCT_INDEX))
+
+	# merge the new orders the same way generate_new_df() does
+	orders = read_input(orders_file)
+	rows = read_input(order_products_file).merge(orders, on='order_id', how='inner')
+	rows['ord_size'] = rows.groupby('order_id')['add_to_cart_order'].transform('max')
+	if (product_codes(index, rows['product_id'].values)<0).any():
+		raise ValueError('New products missing from the product index, rerun the pipeline with the updated products.csv.')
+	rows['aisle_id'] = product_lookup(index, 'aisle')[rows['product_id'].values]
+	rows['department_id'] = product_lookup(index, 'department')[rows['product_id'].values]
+
+	count_products(index, rows[rows['eval_set']=='prior'])
+	state = fold_orders(state, rows[rows['eval_set']=='prior'])
+
+	# the newest train/test order of each user becomes their current order
+	targets = orders[orders['eval_set']!='prior'].sort_values('order_number').groupby('user_id').last().reset_index()
+	targets['target'] = numpy.where(targets['eval_set']=='test', 2, 1)
+	known = state['products'][state['products']['user_id'].isin(targets[targets['target']==2]['user_id'])]
+	target_rows = pd.concat([rows[rows['order_id'].isin(targets['order_id']) & (rows['reordered']==1)][['user_id', 'product_id']],
+							known[['user_id', 'product_id']]])
+	state = set_targets(state, targets, target_rows)
+
+	save_feature_state(state, index)
+
+	# re-emit the affected users' rows
+	user_ids = orders['user_id'].unique()
+	final = state_features(load_feature_state(user_ids), load_overall_averages(), index)
+	for name, part in [('x_test', final[final['target']==2]), ('x_train', final[final['target']!=2])]:
+		old = load_frame(name, output_format)
+		old = old[~old['user_id'].isin(user_ids)]
+		save_frame(pd.concat([old, part], ignore_index=True).sort_values(['user_id', 'product_id']), name, output_format)
+	clear_feature_cache()
+	print("- updated", len(user_ids), "users,", len(final), "rows\n")
+
 def cleanup():
 	import shutil
 	
@@ -451,14 +2175,19 @@ def cleanup():
 		pass
 	
 	try:
-		os.remove('instacart_merged_new.csv')
+		shutil.rmtree('Merged_partitions')
 	except:
 		pass
 	
-	try:
-		os.remove('joined_current.csv')
-	except:
-		pass
+	remove_artifact('instacart_merged_new')
+	remove_artifact('user_costs')
+	remove_artifact('joined_current')
+	if os.path.isfile(PRODUCT_INDEX+'.npz'):
+		os.remove(PRODUCT_INDEX+'.npz')
+	if os.path.isfile(SHARD_PLAN):
+		os.remove(SHARD_PLAN)
+	if os.path.isfile(SQL_DATABASE):
+		os.remove(SQL_DATABASE)
 		
 	try:
 		os.remove('chunks')
@@ -466,27 +2195,134 @@ def cleanup():
 		pass
 	print("Intermediary files cleared.\n")
 	
-clean = input("During the computations, several files will be saved.\nIf you would NOT like these to be cleaned after the computations are completed, enter 'save', else hit enter: ")
-if clean=='save':
-	print("Files will be left as created.\n")
-else:
-	print("Files will be removed after completion.\n")
+# the stages run_pipeline() can run, in order
+STAGES = ['merge', 'chunk', 'compute', 'combine', 'finalize']
+# the outputs of each stage in the cache manifest, forgotten by run_pipeline(force=True)
+STAGE_OUTPUTS = {'merge':['instacart_merged_new'], 'chunk':['chunks'], 'compute':['Chunk_partitions/'],
+				'combine':['joined_current'], 'finalize':['x_train', 'Feature_state']}
 
-print("Computations started at", datetime.now().strftime("%X, %x"), "\n")
-generate_new_df()
+def forget_stage(stage):
+	'''
+	Drops the cache manifest entries of stage's outputs, so the stage runs again even if its key is unchanged.
+	'''
+	manifest = load_manifest()
+	for name in list(manifest['entries']):
+		if any(name==output or (output.endswith('/') and name.startswith(output)) for output in STAGE_OUTPUTS[stage]):
+			del manifest['entries'][name]
+	save_manifest(manifest)
 
-make_chunks()
+def run_pipeline(stages=None, workers=None, memory_budget=None, storage_format=None, output_format=None, engine='pandas',
+				features='vectorized', n_chunks=50, profile=None, cache_limit=None, force=False, clean=False, shards=None, shard=None,
+				feature_state=False):
+	'''
+	Runs the selected stages (all of STAGES by default), in order:
+		merge:    generate_new_df(), merges the competition files into instacart_merged_new
+		chunk:    make_chunks(), splits it into n_chunks cost-balanced partitions
+		compute:  do_computations(), the user-product features of each chunk, on workers processes (all cores by default)
+		combine:  merge_chunks(), gathers the chunks into joined_current
+		finalize: last_merges(), saves x_train and x_test, and with feature_state build_feature_state(), saves Feature_state
+	Stages whose outputs are up to date are skipped (see cache_hit()), unless force is set.
+	memory_budget (in bytes) bounds the merge chunks and the SQL engine's cache; engine='sql' runs the merge, the chunk
+	split and the finalize joins in SQLite; features='python' computes the features with user_computations.
+	storage_format sets STORAGE_FORMAT for the intermediate files, output_format the format of x_train/x_test.
+	Intermediate files beyond cache_limit bytes are evicted at the end, and all of them are removed with clean.
+	With shards, chunk splits the users into that many hash shards instead (make_shards()), compute runs every shard
+	in its own local process (simulate_shards()) and combine gathers them (gather_shards()). shard=k instead runs
+	only the compute stage of shard k, as one job of a sharded run whose shards are spread over several hosts.
+	'''
+	stages = STAGES if stages is None else list(stages)
+	unknown = [stage for stage in stages if stage not in STAGES]
+	if unknown:
+		raise ValueError('Unknown stages {}, expected some of {}'.format(unknown, STAGES))
+	if storage_format is not None:
+		set_storage_format(storage_format)
 
-do_computations()
+	# a shard job leaves the cache manifest to the coordinator
+	if shard is not None:
+		if stages!=['compute']:
+			raise ValueError('A shard job only runs the compute stage')
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore')
+			compute_shard(shard, features, profile, force)
+		return
+
+	print("Computations started at", datetime.now().strftime("%X, %x"), "\n")
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore')
+		for stage in STAGES:
+			if stage not in stages:
+				continue
+			if force:
+				forget_stage(stage)
+			if stage=='merge':
+				generate_new_df(memory_budget, engine)
+			elif stage=='chunk' and shards:
+				make_shards(shards, engine, memory_budget)
+			elif stage=='chunk':
+				make_chunks(n_chunks, engine=engine, memory_budget=memory_budget)
+			elif stage=='compute' and shards:
+				simulate_shards(features, profile, force)
+			elif stage=='compute':
+				do_computations(features, workers or os.cpu_count(), profile)
+			elif stage=='combine' and shards:
+				gather_shards()
+			elif stage=='combine':
+				merge_chunks()
+			else:
+				last_merges(output_format, engine, memory_budget)
+				if feature_state:
+					build_feature_state()
 
-merge_chunks()
+	evict_cache(cache_limit)
+	if clean:
+		cleanup()
+	print("Finished at", datetime.now().strftime("%X, %x"))
 
-last_merges()
+def byte_size(text):
+	'''
+	Parses a size in bytes for the command line, with an optional K, M or G suffix (e.g. 4G).
+	'''
+	units = {'K':2**10, 'M':2**20, 'G':2**30}
+	text = text.strip().upper().rstrip('B')
+	if text and text[-1] in units:
+		return int(float(text[:-1])*units[text[-1]])
+	return int(text)
 
-if clean=='save':
-	print("Cleanup skipped.\n")
-else:
-	cleanup()
+def main(argv=None):
+	'''
+	Command-line entry point, see run_pipeline() and `python feature_engineering.py --help`.
+	'''
+	parser = argparse.ArgumentParser(description='Builds the Instacart feature sets (x_train, x_test) from the competition files in the current folder.')
+	parser.add_argument('stages', nargs='*', metavar='stage',
+						help='stages to run, in order: {} (default: all)'.format(', '.join(STAGES)))
+	parser.add_argument('--workers', type=int, default=None, help='processes for the compute stage (default: all cores)')
+	parser.add_argument('--memory-budget', type=byte_size, default=None, help='memory budget of the merge stage, e.g. 4G')
+	parser.add_argument('--format', dest='storage_format', choices=sorted(EXTENSIONS), default=None,
+						help='format of the intermediate files, the same for every stage (default: {})'.format(STORAGE_FORMAT))
+	parser.add_argument('--output-format', choices=sorted(EXTENSIONS), default=None, help='format of x_train/x_test (default: --format)')
+	parser.add_argument('--engine', choices=['pandas', 'sql'], default='pandas', help='engine of the merge, chunk split and finalize joins')
+	parser.add_argument('--features', choices=['vectorized', 'python'], default='vectorized', help='engine of the compute stage')
+	parser.add_argument('--chunks', dest='n_chunks', type=int, default=50, help='number of chunks (default: 50)')
+	parser.add_argument('--shards', type=int, default=None,
+						help='split the users into this many hash shards, computed by one local process each')
+	parser.add_argument('--shard', type=int, default=None, metavar='K',
+						help='only compute shard K of the plan made by "chunk --shards N", as one job of a multi-host run')
+	parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'], default=None, help='profile the compute stage')
+	parser.add_argument('--cache-limit', type=byte_size, default=None, help='disk cap for the intermediate files, e.g. 20G')
+	parser.add_argument('--feature-state', action='store_true', help='also save Feature_state in the finalize stage, for update_features()')
+	parser.add_argument('--force', action='store_true', help='rerun the selected stages even if their outputs are up to date')
+	keep = parser.add_mutually_exclusive_group()
+	keep.add_argument('--keep', dest='clean', action='store_false', help='keep the intermediate files (default)')
+	keep.add_argument('--clean', dest='clean', action='store_true', help='remove the intermediate files when done')
+	parser.set_defaults(clean=False)
+	args = parser.parse_args(argv)
+	unknown = [stage for stage in args.stages if stage not in STAGES]
+	if unknown:
+		parser.error('unknown stages {}, choose from {}'.format(', '.join(unknown), ', '.join(STAGES)))
+	if not args.stages:
+		args.stages = ['compute'] if args.shard is not None else STAGES
 
+	run_pipeline(**vars(args))
 
-print("Finished at", datetime.now().strftime("%X, %x"))
\ No newline at end of file
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+	'''
+	Synthetic competition files (see benchmark.generate_data()) for 60 users, where the first train user's
+	train order only holds a product new to them, so none of their products is reordered in it, and one more
+	train user whose average days between orders, 323/40 = 8.075, is a tie when rounded to 2 decimals.
+	'''
+	folder = str(tmp_path_factory.mktemp('dataset'))
+	benchmark.generate_data(60, folder, seed=1, n_products=2000)
+	orders = pd.read_csv(os.path.join(folder, 'orders.csv'))
+	prior = pd.read_csv(os.path.join(folder, 'order_products__prior.csv'))
+	train = pd.read_csv(os.path.join(folder, 'order_products__train.csv'))
+
+	order = orders[orders['eval_set']=='train'].iloc[0]
+	seen = prior.loc[prior['order_id'].isin(orders.loc[orders['user_id']==order['user_id'], 'order_id']), 'product_id']
+	product_id = min(set(range(1, 2001))-set(seen))
+	train = pd.concat([train[train['order_id']!=order['order_id']],
+					pd.DataFrame({'order_id':[order['order_id']], 'product_id':[product_id], 'add_to_cart_order':[1], 'reordered':[0]})])
+
+	# 41 prior orders 8 or 9 days apart, and a train order reordering one of their products
+	user_id, first = orders['user_id'].max()+1, orders['order_id'].max()+1
+	order_ids = list(range(first, first+42))
+	orders = pd.concat([orders, pd.DataFrame({'order_id':order_ids, 'user_id':user_id, 'eval_set':['prior']*41+['train'],
+		'order_number':range(1, 43), 'order_dow':3, 'order_hour_of_day':10, 'days_since_prior_order':[None]+[9]*3+[8]*38})])
+	prior = pd.concat([prior, pd.DataFrame({'order_id':[order_id for order_id in order_ids[:-1] for position in range(2)],
+		'product_id':[1, 2]*41, 'add_to_cart_order':[1, 2]*41, 'reordered':[0, 0]+[1, 1]*40})])
+	train = pd.concat([train, pd.DataFrame({'order_id':[order_ids[-1]], 'product_id':[1], 'add_to_cart_order':[1], 'reordered':[1]})])
+
+	orders.to_csv(os.path.join(folder, 'orders.csv'), index=False)
+	prior.to_csv(os.path.join(folder, 'order_products__prior.csv'), index=False)
+	train.to_csv(os.path.join(folder, 'order_products__train.csv'), index=False)
+	return folder
+
+
+@pytest.fixture
+def workdir(dataset, tmp_path, monkeypatch):
+	'''
+	A copy of the dataset as the current folder, where the pipeline writes its files.
+	'''
+	for name in os.listdir(dataset):
+		shutil.copy(os.path.join(dataset, name), str(tmp_path))
+	monkeypatch.chdir(tmp_path)
+	return tmp_path
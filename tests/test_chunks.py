@@ -0,0 +1,50 @@
+import pickle
+
+import pandas as pd
+
+import feature_engineering as fe
+
+
+def partition_digests(n_chunks):
+	return [fe.file_digest(fe.artifact_path(fe.partition_name(i))) for i in range(n_chunks)]
+
+
+def test_new_rows_only_change_their_users_chunk(workdir):
+	fe.generate_new_df()
+	fe.make_chunks(4)
+	fe.do_computations()
+	with open('chunks', 'rb') as fp:
+		chunks = pickle.load(fp)
+	digests = partition_digests(4)
+	keys = [fe.chunk_key(i) for i in range(4)]
+
+	# new products in a prior order of the cheapest user, which moves them up the order balanced_chunks() packs users in
+	costs = fe.user_costs()
+	orders = pd.read_csv('orders.csv')
+	prior = pd.read_csv('order_products__prior.csv')
+	user_id = costs.sort_values('cost')['user_id'].iloc[0]
+	order = orders[(orders['user_id']==user_id) & (orders['eval_set']=='prior')].iloc[0]
+	in_order = prior.loc[prior['order_id']==order['order_id'], 'product_id']
+	product_ids = sorted(set(range(1, 2001))-set(in_order))[:20]
+	rows = pd.DataFrame({'order_id':order['order_id'], 'product_id':product_ids,
+						'add_to_cart_order':range(len(in_order)+1, len(in_order)+21), 'reordered':0})
+	pd.concat([prior, rows]).to_csv('order_products__prior.csv', index=False)
+
+	fe.generate_new_df()
+	fe.make_chunks(4)
+	with open('chunks', 'rb') as fp:
+		assert pickle.load(fp)==chunks
+	changed = [i for i, digest in enumerate(partition_digests(4)) if digest!=digests[i]]
+	assert changed==[i for i in range(4) if user_id in chunks[i]]
+
+	pending = [i for i in range(4) if not fe.cache_hit(fe.chunk_name(i), fe.chunk_key(i))]
+	assert pending==changed
+	assert [fe.chunk_key(i)==keys[i] for i in range(4)]==[i not in changed for i in range(4)]
+
+
+def test_balanced_chunks_places_new_users():
+	costs = pd.DataFrame({'user_id':[2, 3, 4, 5], 'cost':[10, 8, 1, 3]})
+	chunks, totals = fe.balanced_chunks(costs, 2, previous=[[1, 2], [5]])
+	# user 1 is gone, 2 and 5 stay, 3 then 4 go to the cheapest chunk
+	assert chunks==[[2, 4], [5, 3]]
+	assert list(totals)==[11, 11]
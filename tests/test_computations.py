@@ -0,0 +1,21 @@
+import pandas as pd
+
+import feature_engineering as fe
+
+
+def test_vectorized_matches_user_computations(workdir):
+	fe.generate_new_df()
+	# the row order of a Merged_partitions file, newest orders first
+	new = fe.load_frame('instacart_merged_new').sort_values(['target', 'order_number'], ascending=[False, False], kind='mergesort')
+	# a train user without reordered products has no rows of their train order
+	orders = pd.read_csv('orders.csv')
+	assert set(orders.loc[orders['eval_set']=='train', 'user_id'])-set(new.loc[new['target']==1, 'user_id'])
+
+	expected = new.groupby('user_id').apply(fe.user_computations).reset_index().drop('level_1', axis=1)
+	joined = fe.vectorized_computations(new)
+
+	key = ['user_id', 'product_id', 'order_number']
+	expected = fe.apply_schema(expected[fe.CHUNK_COLUMNS]).sort_values(key).reset_index(drop=True)
+	joined = fe.apply_schema(joined).sort_values(key).reset_index(drop=True)
+	assert len(joined)==len(expected)
+	pd.testing.assert_frame_equal(joined, expected)
@@ -0,0 +1,73 @@
+import os
+
+import pandas as pd
+
+import feature_engineering as fe
+
+
+def state_rows(user_ids=None):
+	state = fe.load_feature_state(user_ids)
+	return state_features(state)
+
+
+def state_features(state):
+	final = fe.state_features(state, fe.load_overall_averages(), fe.load_product_index(fe.state_name(fe.PRODUCT_INDEX)))
+	return final.reset_index(drop=True)
+
+
+def test_update_features_matches_full_run(workdir):
+	'''
+	Users whose test order becomes a prior order, followed by a new test order, get the rows of a full run.
+	'''
+	orders = pd.read_csv('orders.csv')
+	prior = pd.read_csv('order_products__prior.csv')
+	train = pd.read_csv('order_products__train.csv')
+
+	# the old data stops one order earlier for 20 users, whose second to last order is their test order
+	last = orders['order_number']==orders.groupby('user_id')['order_number'].transform('max')
+	user_ids = orders.loc[last & (orders['eval_set']!='prior'), 'user_id'].values[:20]
+	affected = orders['user_id'].isin(user_ids)
+	newest = orders[affected & last]
+	second = orders[affected & (orders['order_number']==orders.groupby('user_id')['order_number'].transform('max')-1)]
+
+	os.mkdir('old')
+	old_orders = orders[~orders['order_id'].isin(newest['order_id'])].copy()
+	old_orders.loc[old_orders['order_id'].isin(second['order_id']), 'eval_set'] = 'test'
+	old_orders.to_csv('old/orders.csv', index=False)
+	prior[~prior['order_id'].isin(second['order_id'])].to_csv('old/order_products__prior.csv', index=False)
+	train[~train['order_id'].isin(newest['order_id'])].to_csv('old/order_products__train.csv', index=False)
+	pd.read_csv('products.csv').to_csv('old/products.csv', index=False)
+	pd.concat([second, newest]).to_csv('old/new_orders.csv', index=False)
+	pd.concat([prior[prior['order_id'].isin(second['order_id'])], train[train['order_id'].isin(newest['order_id'])]]).to_csv('old/new_items.csv', index=False)
+
+	fe.generate_new_df()
+	fe.make_chunks(4)
+	fe.build_feature_state()
+	expected = state_rows()
+	expected = expected[expected['user_id'].isin(user_ids)].reset_index(drop=True)
+
+	os.chdir('old')
+	fe.generate_new_df()
+	fe.make_chunks(4)
+	fe.build_feature_state()
+	final = state_rows()
+	fe.save_frame(final[final['target']==2], 'x_test')
+	fe.save_frame(final[final['target']!=2], 'x_train')
+	fe.update_features('new_orders.csv', 'new_items.csv')
+
+	x = pd.concat([fe.load_frame('x_train'), fe.load_frame('x_test')])
+	x = x[x['user_id'].isin(user_ids)].sort_values(['user_id', 'product_id']).reset_index(drop=True)
+	assert len(x)==len(expected)
+	pd.testing.assert_frame_equal(x, fe.apply_schema(expected), check_dtype=False, atol=1e-6)
+
+
+def test_feature_state_built_per_partition(workdir):
+	fe.generate_new_df()
+	fe.make_chunks(4)
+	fe.build_feature_state()
+	expected = fe.merged_state(fe.load_frame('instacart_merged_new'), fe.target_orders())
+	state = fe.load_feature_state()
+	for table, key in [('users', ['user_id']), ('products', ['user_id', 'product_id']), ('aisles', ['user_id', 'aisle_id']),
+					('departments', ['user_id', 'department_id'])]:
+		expected_table = fe.apply_schema(expected[table]).sort_values(key).reset_index(drop=True)
+		pd.testing.assert_frame_equal(state[table], expected_table[state[table].columns])
@@ -0,0 +1,118 @@
+import os
+
+import numpy
+import pandas as pd
+
+import feature_engineering as fe
+
+
+def baseline_rows(new):
+	'''
+	The relational part of last_merges() as it was before its aggregations were reworked: each user-product pair's
+	most recent row, merged with the user-based values, the average order position and the user's current order.
+	'''
+	new = new.astype({col:'float64' for col in new.columns if new[col].dtype=='float32'})
+	new = new.sort_values(['target', 'order_number'], ascending=[False, False])
+	final = new.groupby(['user_id', 'product_id']).first().reset_index()
+	new = new[new['eval_set']=='prior']
+
+	user_only = pd.DataFrame(new.groupby('user_id')['reordered'].mean())
+	user_only['prev_ord_size'] = new[['user_id', 'order_number', 'ord_size']].drop_duplicates().sort_values('order_number', ascending=False).groupby('user_id').first()['ord_size']
+	user_only.columns = ['reordered_usr_avg', 'prev_ord_size']
+	final = final.merge(user_only.reset_index(), on='user_id', how='left')
+
+	user_product = new.groupby(['user_id', 'product_id'])[['add_to_cart_order', 'ord_size']].sum().reset_index().astype(float)
+	user_product['avg_ord_pos'] = (user_product['add_to_cart_order']/user_product['ord_size']).round(2)
+	final = final.merge(user_product[['user_id', 'product_id', 'avg_ord_pos']], on=['user_id', 'product_id'], how='left')
+
+	orders = new.drop_duplicates('order_id').groupby('user_id')
+	final = final.merge(orders['days_since_prior_order'].mean().rename('avg_days_between_orders').reset_index(), on='user_id', how='left')
+	final = final.merge(orders['ord_size'].mean().rename('avg_order_size').reset_index(), on='user_id', how='left')
+
+	# the hour and day of each user's train/test order, for the lifts
+	current = pd.read_csv('orders.csv').query("eval_set!='prior'")[['user_id', 'order_hour_of_day', 'order_dow']]
+	current.columns = ['user_id', 'target_hour', 'target_dow']
+	return final.merge(current, on='user_id', how='left')
+
+
+def baseline_last_merges(new, current):
+	'''
+	Joins baseline_rows() with the user computations and the overall averages as last_merges() used to.
+	'''
+	final = baseline_rows(new)
+	final = final.merge(current, on=['user_id', 'product_id', 'order_number'], how='left')
+	final.rename(columns={'avg_prod_disp':'usr_avg_prod_disp', 'avg_aisle_disp':'usr_avg_aisle_disp',
+						'avg_dept_disp':'usr_avg_dept_disp'}, inplace=True)
+	for key, col in [('product_id', 'prod'), ('aisle_id', 'aisle'), ('department_id', 'dept')]:
+		overall = final.drop_duplicates(['user_id', key]).groupby(key)['usr_avg_{}_disp'.format(col)].mean()
+		final = final.merge(overall.rename('overall_avg_{}_disp'.format(col)).reset_index(), on=key, how='left')
+	del final['target_y']
+	final.rename(columns={'order_number_max':'num_orders_placed', 'target_x':'target'}, inplace=True)
+	return fe.finalize_features(fe.product_features(final, fe.load_product_index()))
+
+
+def run_pipeline():
+	fe.generate_new_df()
+	fe.make_chunks(4)
+	fe.do_computations()
+	fe.merge_chunks()
+
+
+def test_final_rows_match_baseline(workdir):
+	run_pipeline()
+	final = fe.final_rows()
+	expected = baseline_rows(fe.load_frame('instacart_merged_new'))[final.columns]
+	pd.testing.assert_frame_equal(final.astype(float), expected.astype(float), rtol=1e-5)
+
+
+def test_last_merges_matches_baseline(workdir):
+	run_pipeline()
+	fe.last_merges()
+	x = pd.concat([fe.load_frame('x_train'), fe.load_frame('x_test')]).sort_values(['user_id', 'product_id']).reset_index(drop=True)
+	expected = baseline_last_merges(fe.load_frame('instacart_merged_new'), fe.load_frame('joined_current'))
+	expected = expected.sort_values(['user_id', 'product_id']).reset_index(drop=True)
+	assert list(x.columns)==list(expected.columns)
+	pd.testing.assert_frame_equal(x.astype(float), expected.astype(float), rtol=1e-5, atol=1e-6)
+
+
+def test_last_merges_rerun_is_cached(workdir):
+	run_pipeline()
+	fe.last_merges()
+	key = fe.stage_key('last_merges', fe.cache_key('instacart_merged_new'), fe.cache_key('joined_current'), None)
+	assert fe.cache_key('x_train')==key
+	mtime = os.path.getmtime(fe.artifact_path('x_train'))
+	fe.last_merges()
+	assert os.path.getmtime(fe.artifact_path('x_train'))==mtime
+
+
+def test_user_averages_round_in_float64(workdir):
+	run_pipeline()
+	fe.last_merges()
+	x_train = fe.load_frame('x_train')
+	# the fixture's last user averages 8.075 days between orders, which float64 rounds down and float32 up
+	user = x_train[x_train['user_id']==x_train['user_id'].max()]
+	assert (user['avg_days_between_orders']==numpy.float32(8.07)).all()
+
+
+def test_lifts_use_the_current_order(workdir):
+	run_pipeline()
+	fe.last_merges()
+	fe.build_feature_state()
+	x = pd.concat([fe.load_frame('x_train'), fe.load_frame('x_test')]).sort_values(['user_id', 'product_id']).reset_index(drop=True)
+
+	orders = pd.read_csv('orders.csv')
+	prior = pd.read_csv('order_products__prior.csv').merge(orders, on='order_id')
+	prior['period'] = fe.HOUR_PERIOD[prior['order_hour_of_day'].values]
+	current = orders[orders['eval_set']!='prior'].set_index('user_id').loc[x['user_id']]
+	# every row of a user, whatever its target, is scored for the hour and day of the user's train/test order
+	for col, values in [('period', fe.HOUR_PERIOD[current['order_hour_of_day'].values]), ('order_dow', current['order_dow'].values)]:
+		counts = pd.crosstab(prior['product_id'], prior[col])
+		share = (counts/counts.values.sum()).sum()
+		expected = counts.values[counts.index.get_indexer(x['product_id']), counts.columns.get_indexer(values)]
+		expected = expected/counts.sum(axis=1).loc[x['product_id']].values/share.loc[values].values
+		lift = x['tod_lift' if col=='period' else 'dow_lift']
+		numpy.testing.assert_allclose(lift, expected.round(3), atol=1e-6)
+
+	state = fe.load_feature_state()
+	rows = fe.state_features(state, fe.load_overall_averages(), fe.load_product_index(fe.state_name(fe.PRODUCT_INDEX)))
+	pd.testing.assert_frame_equal(fe.apply_schema(rows[['tod_lift', 'dow_lift']]), x[['tod_lift', 'dow_lift']])
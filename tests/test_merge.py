@@ -0,0 +1,21 @@
+import pandas as pd
+import pytest
+
+import feature_engineering as fe
+
+
+def test_budgeted_merge_matches_single_chunk(workdir, monkeypatch):
+	fe.pandas_generate_new_df()
+	new, costs = fe.load_frame('instacart_merged_new'), fe.load_frame('user_costs')
+
+	# chunks of about 100 rows, so the test-user stubs are split too
+	monkeypatch.setattr(fe, 'ROW_BYTES', 10**7)
+	monkeypatch.setattr(fe, 'MIN_CHUNK_ROWS', 1)
+	fe.pandas_generate_new_df(10**9)
+	pd.testing.assert_frame_equal(fe.load_frame('instacart_merged_new'), new)
+	pd.testing.assert_frame_equal(fe.load_frame('user_costs'), costs)
+
+
+def test_too_small_memory_budget_raises(workdir):
+	with pytest.raises(ValueError, match='too small'):
+		fe.pandas_generate_new_df(fe.MIN_CHUNK_ROWS*fe.ROW_BYTES)
@@ -0,0 +1,41 @@
+import numpy
+import pytest
+
+import feature_engineering as fe
+
+LEVELS = ['products', 'aisles', 'departments']
+ROWS = {'products':'row_product', 'aisles':'row_aisle', 'departments':'row_department'}
+
+
+def histories():
+	fe.generate_new_df()
+	new = fe.load_frame('instacart_merged_new').sort_values(['user_id', 'target', 'order_number'], ascending=[True, False, False], kind='mergesort')
+	return [fe.encode_history(group) for _, group in new.groupby('user_id')]
+
+
+def assert_walks_match(kernel, history, level):
+	expected = fe.walk_presence(history['present_'+level], history, track_orders=True)
+	support, days_since, disp_sum, disp_count, orders_since, streak = kernel(history['order_start'], history[ROWS[level]], history['n_'+level],
+			history['order_days'], history['in_target'], history['order_number'], history['order_num_max'])
+	with numpy.errstate(invalid='ignore', divide='ignore'):
+		avg_disp = numpy.round(disp_sum/disp_count, 2)
+	for name, value, reference in zip(['support', 'days_since', 'avg_disp', 'orders_since', 'streak'],
+									[support, days_since, avg_disp, orders_since, streak], expected):
+		numpy.testing.assert_array_equal(value, reference, err_msg='{} of {}'.format(name, level))
+
+
+@pytest.mark.parametrize('level', LEVELS)
+def test_walk_orders_matches_walk_presence(workdir, level):
+	# walk_orders run as plain Python, uncompiled
+	for history in histories():
+		assert_walks_match(fe.walk_orders, history, level)
+
+
+def test_numba_walk_matches_walk_presence(workdir):
+	pytest.importorskip('numba')
+	kernel = fe.numba_walk()
+	for history in histories():
+		for level in LEVELS:
+			assert_walks_match(kernel, history, level)
+			numpy.testing.assert_array_equal(numpy.column_stack(fe.walk_level(level, history, kernel, True)),
+											numpy.column_stack(fe.walk_level(level, history, None, True)))
@@ -0,0 +1,38 @@
+import multiprocessing
+import os
+
+import pandas as pd
+import pytest
+
+import feature_engineering as fe
+
+
+@pytest.fixture
+def spawn(monkeypatch):
+	'''
+	Worker processes started by spawn, as on Windows and macOS, which import feature_engineering afresh.
+	'''
+	method = multiprocessing.get_start_method()
+	multiprocessing.set_start_method('spawn', force=True)
+	# run_pipeline() sets the format for the rest of the session
+	monkeypatch.setattr(fe, 'STORAGE_FORMAT', fe.STORAGE_FORMAT)
+	yield
+	multiprocessing.set_start_method(method, force=True)
+
+
+def test_workers_use_the_storage_format(workdir, spawn):
+	fe.run_pipeline(['merge', 'chunk', 'compute'], workers=2, storage_format='csv', n_chunks=4)
+	for i in range(4):
+		assert fe.artifact_exists(fe.chunk_name(i), 'csv')
+		assert not fe.artifact_exists(fe.chunk_name(i), 'parquet')
+	joined = pd.concat([fe.load_frame(fe.chunk_name(i)) for i in range(4)])
+	assert set(joined['user_id'])==set(fe.load_frame('instacart_merged_new')['user_id'])
+
+
+def test_feature_state_is_opt_in(workdir):
+	fe.main(['--chunks', '4', '--workers', '1'])
+	assert fe.artifact_exists('x_train')
+	assert not os.path.exists('Feature_state')
+
+	fe.main(['finalize', '--feature-state'])
+	assert fe.artifact_exists(fe.state_name('users'))
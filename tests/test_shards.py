@@ -0,0 +1,48 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import feature_engineering as fe
+
+
+def outputs():
+	key = ['user_id', 'product_id', 'order_number']
+	joined = fe.load_frame('joined_current').sort_values(key).reset_index(drop=True)
+	x_train = fe.load_frame('x_train').sort_values(['user_id', 'product_id']).reset_index(drop=True)
+	return joined, x_train
+
+
+def test_sharded_run_matches_chunked_run(workdir):
+	# every shard is computed by its own process (see simulate_shards())
+	fe.run_pipeline(shards=3, workers=1)
+	joined, x_train = outputs()
+	assert all(os.path.isfile(fe.shard_marker(k)) for k in range(3))
+
+	fe.run_pipeline(['chunk', 'compute', 'combine', 'finalize'], workers=1, n_chunks=4, force=True)
+	expected_joined, expected_x_train = outputs()
+	pd.testing.assert_frame_equal(joined, expected_joined)
+	pd.testing.assert_frame_equal(x_train, expected_x_train)
+
+
+def test_gather_shards_needs_every_marker(workdir):
+	fe.run_pipeline(['merge', 'chunk', 'compute'], shards=3, workers=1)
+	fe.gather_shards()
+
+	os.remove(fe.shard_marker(0))
+	with pytest.raises(IOError, match=r'Shards \[0\] of 3'):
+		fe.gather_shards()
+
+	# a marker left by an earlier plan, whose partition has changed since
+	fe.compute_shard(0)
+	with open(fe.shard_marker(1)) as fp:
+		marker = json.load(fp)
+	marker['key'] = 'stale'
+	with open(fe.shard_marker(1), 'w') as fp:
+		json.dump(marker, fp)
+	with pytest.raises(IOError, match=r'Shards \[1\] of 3'):
+		fe.gather_shards()
+
+	fe.compute_shard(1)
+	fe.gather_shards()
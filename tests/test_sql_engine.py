@@ -0,0 +1,65 @@
+import os
+
+import numpy
+import pandas as pd
+
+import feature_engineering as fe
+
+
+def merge_outputs():
+	return fe.load_frame('instacart_merged_new'), fe.load_frame('user_costs'), fe.load_product_index()
+
+
+def test_sql_engine_matches_pandas(workdir):
+	fe.generate_new_df(engine='pandas')
+	new, costs, index = merge_outputs()
+	final = fe.final_rows()
+
+	# the merge is cached per engine
+	fe.generate_new_df(engine='sql')
+	assert os.path.isfile(fe.SQL_DATABASE)
+	sql_new, sql_costs, sql_index = merge_outputs()
+	pd.testing.assert_frame_equal(sql_new, new)
+	pd.testing.assert_frame_equal(sql_costs, costs)
+	assert sorted(sql_index)==sorted(index)
+	for name in index:
+		numpy.testing.assert_array_equal(sql_index[name], index[name], err_msg=name)
+
+	pd.testing.assert_frame_equal(fe.sql_final_rows(), final)
+
+
+def test_sql_finalize_after_pandas_merge(workdir):
+	fe.generate_new_df(engine='pandas')
+	fe.make_chunks(4)
+	fe.do_computations()
+	fe.merge_chunks()
+	fe.last_merges()
+	x_train = fe.load_frame('x_train')
+
+	fe.generate_new_df(engine='sql')
+	assert fe.SQL_DATABASE in fe.load_manifest()['entries']['instacart_merged_new']['files']
+	# the database is an output of the merge, so the merge runs again without it
+	os.remove(fe.SQL_DATABASE)
+	fe.generate_new_df(engine='sql')
+	fe.make_chunks(4)
+	fe.do_computations()
+	fe.merge_chunks()
+	fe.last_merges(engine='sql')
+	pd.testing.assert_frame_equal(fe.load_frame('x_train'), x_train)
+
+
+def test_sql_partitions_match_pandas(workdir, monkeypatch):
+	fe.generate_new_df(engine='pandas')
+	fe.make_chunks(4)
+	parts = [fe.load_frame(fe.partition_name(i)) for i in range(4)]
+
+	fe.generate_new_df(engine='sql')
+	load_frame = fe.load_frame
+	def partial_load(name, *args, **kwargs):
+		assert name!='instacart_merged_new', 'the sql engine loaded the whole merged data'
+		return load_frame(name, *args, **kwargs)
+	monkeypatch.setattr(fe, 'load_frame', partial_load)
+	fe.make_chunks(4, engine='sql')
+	fe.build_feature_state()
+	for i in range(4):
+		pd.testing.assert_frame_equal(fe.load_frame(fe.partition_name(i)), parts[i])